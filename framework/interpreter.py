@@ -8,7 +8,10 @@ import framework.lex as lex
 from framework.miniparse import *
 import sys
 from framework.trace import *
-from framework.peg import parse_expr_str
+from framework.peg import parse_expr_template
+
+# Returned by Interpreter.step() once execution runs off the end of the file
+DONE = object()
 
 class Interpreter:
     """Main interpreter class"""
@@ -22,16 +25,71 @@ class Interpreter:
         self.curr_lexeme = self.lexing.lexemes[0]
         self.break_lines = dict()
         self.is_globals_pass = False
+        # Function bodies (by opening {) already ending in a return statement.
+        self.returnified_ = set()
+        # Maps a call's argument lexemes -> parse trees of each argument.
+        self.fn_args_memo_ = dict()
+        # Maps (snippet, number of args) -> (arg labels, return lexeme) of an
+        # exec_c snippet already prepended to the lexing; see exec_c.
+        self.exec_c_memo_ = dict()
+        self.exec_c_active_ = set()
+        # Maps parse tree labels to the methods interpreting them.
+        self.stmt_handlers = dict({
+            "Function": self.stmt_function,
+            "Preproc": self.stmt_preproc,
+            "Statement": self.stmt_statement,
+            "Label": self.stmt_label,
+            "Return": self.stmt_return,
+            "GotoITE": self.stmt_goto_ite,
+            "Goto": self.stmt_goto,
+            "For": self.stmt_for,
+            "While": self.stmt_while,
+            "IfStmt": self.stmt_if,
+            "Block": self.stmt_block,
+            "EndBlock": self.stmt_end_block,
+            "Line": self.stmt_line,
+            "Switch": self.stmt_switch,
+        })
+        self.expr_handlers = dict({
+            "Member": self.expr_member,
+            "Assign": self.expr_assign,
+            "Inc": self.expr_inc,
+            "Lits": self.expr_lits,
+            "pre_sizeof": self.expr_sizeof,
+            "pre_!": self.expr_not,
+            "pre_*": self.expr_deref,
+            "pre_&": self.expr_addr_of,
+            "InitList": self.expr_init_list,
+            "StructDecl": self.expr_struct_decl,
+            "UnionDecl": self.expr_union_decl,
+            "EnumDecl": self.expr_enum_decl,
+            "DerefMember": self.expr_deref_member,
+            "Nth": self.expr_nth,
+            "FnCall": self.expr_fn_call,
+        })
 
     def globals_pass(self):
         """Runs a pass over globals in the file"""
         self.curr_lexeme = self.lexing.lexemes[0]
         self.is_globals_pass = True
-        while True:
-            try:                    self.step()
-            except StopIteration:   break
+        while self.step() is not DONE:
+            pass
         self.is_globals_pass = False
 
+    def run_until_return(self, max_steps=None):
+        """Steps until a return statement is reached
+
+        Returns that step's ["return", return_value], or None if execution
+        ran off the end instead. If @max_steps is given, also gives up (and
+        returns None) after that many steps.
+        """
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            steps += 1
+            result = self.step()
+            if result is DONE: return None
+            if result and result[0] == "return": return result
+
     def set_to_line(self, line):
         """Set the execution head to a given line number"""
         self.curr_lexeme = self.lexing.after_line_number(line)[0]
@@ -44,48 +102,74 @@ class Interpreter:
         """Interpret for a single step from self.curr_lexeme
 
         If a return ... statement is reached, will return ["return",
-        return_value].
+        return_value]. Once there is nothing left to run, returns DONE.
         """
-        if self.curr_lexeme is None: raise StopIteration
-        if self.curr_lexeme.line_number in self.break_lines:
+        if self.curr_lexeme is None: return DONE
+        # Checking for emptiness first skips computing the line number, which
+        # counts newlines in the file, whenever no breakpoints are set.
+        if self.break_lines and self.curr_lexeme.line_number in self.break_lines:
             self.break_lines[self.curr_lexeme.line_number](self)
         # print("EXECUTING LINE:", self.curr_lexeme.line_number)
         assert self.curr_lexeme.lexing is self.lexing
-        start_i = self.lexing.lexemes.index(self.curr_lexeme)
-        lexemes = self.lexing.lexemes[start_i:]
-        # print(" ".join([l.string for l in lexemes[:100]]))
-        tree, lexemes = parse_some_cf(lexemes)
-        return self.interpret(tree)
+        start_i = self.lexing.index(self.curr_lexeme)
+        # print(" ".join([l.string for l in self.lexing.lexemes[start_i:start_i+100]]))
+        # Parse in place rather than copying the rest of the file every step.
+        tree, _ = parse_lexing_cf(self.lexing, start_i)
+        # parse_some_cf always wraps its result in a Statement node, so
+        # dispatch directly on the statement instead of re-entering interpret.
+        assert tree[0] == "Statement"
+        return self.interpret(tree[1])
 
     def exec_c(self, string, *args):
         """Executes C code directly
 
+        Each @string is only prepended to the lexing once; calling it again
+        with the same number of arguments reruns the same code with the new
+        arguments bound to the same labels. A snippet that (indirectly) runs
+        itself again gets a fresh copy, since the labels are still in scope.
+
         TODO: Should this always be wrapped in a freeze_explanations()?
         """
-        arg_names = self.trace.gen_labels(len(args))
-        for i, label in enumerate(arg_names):
-            string = string.replace(f"{{{i}}}", f" {label} ")
-        string = string.replace("{", "{{").replace("}", "}}")
+        key = (string, len(args))
+        cached = self.exec_c_memo_.get(key)
+        if (cached is None or cached[1].lexing is not self.lexing
+                or key in self.exec_c_active_):
+            cached = self.compile_c_(string, len(args))
+            if key not in self.exec_c_active_:
+                self.exec_c_memo_[key] = cached
+        arg_names, return_lexeme = cached
 
         old_lexing, old_lexeme = self.lexing, self.curr_lexeme
-        new_lexemes = self.lexing.prepend(self.lexing.lexemes[0],
-                f"void ___ssi_code() {{{{ return {string}; }}}}")
-        self.curr_lexeme = next(l for l in new_lexemes if l.string == "return")
+        self.curr_lexeme = return_lexeme
+        reentered = key in self.exec_c_active_
+        self.exec_c_active_.add(key)
 
         self.trace.push_scope(arg_names,
                               [a if isinstance(a, Value)
                                else Value(a, True, self.trace)
                                for a in args])
-        while True:
-            try:
-                result = self.step()
-                if result and result[0] == "return":
-                    break
-            except StopIteration: break
+        result = self.run_until_return()
         self.lexing, self.curr_lexeme = old_lexing, old_lexeme
         self.trace.pop_scope()
+        if not reentered:
+            self.exec_c_active_.discard(key)
         return result[1]
 
+    def compile_c_(self, string, n_args):
+        """Prepends @string for exec_c as the body of a new function
+
+        Returns the labels standing in for the @n_args arguments and the
+        lexeme of the function's return statement.
+        """
+        arg_names = self.trace.gen_labels(n_args)
+        for i, label in enumerate(arg_names):
+            string = string.replace(f"{{{i}}}", f" {label} ")
+        string = string.replace("{", "{{").replace("}", "}}")
+        new_lexemes = self.lexing.prepend(self.lexing.lexemes[0],
+                f"void ___ssi_code() {{{{ return {string}; }}}}")
+        return_lexeme = next(l for l in new_lexemes if l.string == "return")
+        return arg_names, return_lexeme
+
     def replace_stmts(self, lexemes, replace_stmt, skip_over,
                       replace_with_str):
         """Look for a type of statement and rewrite matches
@@ -107,160 +191,178 @@ class Interpreter:
         Return value can be None (default) or ["retrun", return_value] if it's
         a return statement.
         """
-        if tree[0] in ("Function",):
-            bal_id = next(i for i, s in enumerate(tree) if s[0] == "bal")
-            fn_name_lex = relex(tree[bal_id - 1])[-1]
-            memloc = self.trace.local(fn_name_lex.string)
-            self.emit("(upd (imm {0}) {1})", ("fn", find_fn(fn_name_lex)), memloc)
-            self.curr_lexeme = relex(tree)[-1].next_lexeme()
-        elif tree[0] in ("Preproc",):
-            macro = parse_macro(relex(tree)[0].string)
-            if macro is None:
-                self.curr_lexeme = self.curr_lexeme.next_lexeme()
-                return
-            if macro["args"] is None:
-                to_replace = [l for l in relex(tree)[-1].suffix() if l.string == macro["name"]]
-                pattern = " ".join(macro["pattern"]).replace("{", "{{").replace("}", "}}")
-                for lexeme in to_replace:
-                    self.lexing.rewrite([lexeme, lexeme], pattern)
-            else:
-                starts = [l for l in relex(tree)[-1].suffix()
-                          if l.string == macro["name"] and l.next_lexeme().string == "("]
-                for lexeme in starts:
-                    all_lexemes, args = [lexeme, lexeme.next_lexeme()], [[]]
-                    l = all_lexemes[-1]
-                    depth = 0
-                    while True:
-                        l = l.next_lexeme()
-                        all_lexemes.append(l)
-                        if l.string == "(": depth += 1
-                        if l.string == ")": depth -= 1
-                        if depth < 0: break
-                        if l.string == "," and depth == 0: args.append([])
-                        else:               args[-1].append(l)
-                    pattern = ""
-                    for x in macro["pattern"]:
-                        if isinstance(x, str):
-                            pattern += " " + x.replace("{", "{{").replace("}", "}}")
-                        elif isinstance(x, int):
-                            pattern += " " + f"{{{x}}}"
-                        elif x[0] == "strify":
-                            assert x[0] == "strify"
-                            pattern += " " + "\"" + " ".join([l.string for l in args[x[1]]]) + "\""
-                        elif x[0] == "pasteify":
-                            pattern += " ".join([l.string for l in args[x[1]]])
-                        elif x[0] == "pasteify-str":
-                            pattern += x[1]
-                        else:
-                            raise NotImplementedError
-                    self.lexing.rewrite(all_lexemes, pattern, dict({str(i): v for i, v in enumerate(args)}))
-            self.curr_lexeme = relex(tree)[-1].next_lexeme()
-            self.lexing.rewrite(relex(tree), "")
+        handler = self.stmt_handlers.get(tree[0])
+        if handler is None:
+            print(tree)
+            raise NotImplementedError
+        return handler(tree)
+
+    def stmt_function(self, tree):
+        """Records a function definition in its name's memory location"""
+        bal_id = next(i for i, s in enumerate(tree) if s[0] == "bal")
+        fn_name_lex = relex(tree[bal_id - 1])[-1]
+        memloc = self.trace.local(fn_name_lex.string)
+        # During the globals pass we are stepping over top-level definitions,
+        # which is exactly what find_fn would otherwise search the file for.
+        signature = find_fn(fn_name_lex, tree if self.is_globals_pass else None)
+        self.emit("(upd (imm {0}) {1})", ("fn", signature), memloc)
+        self.curr_lexeme = relex(tree)[-1].next_lexeme()
+
+    def stmt_preproc(self, tree):
+        """Expands a #define through the rest of the file"""
+        lexemes = relex(tree)
+        macro = parse_macro(lexemes[0].string)
+        if macro is None:
+            self.curr_lexeme = self.curr_lexeme.next_lexeme()
             return
-        elif tree[0] == "Statement":
-            return self.interpret(tree[1])
-        elif tree[0] == "Label":
-            self.curr_lexeme = relex(tree[3])[0]
-        elif tree[0] == "Return":
-            return ["return", self.interpret_expr(parse_some_expr(relex(tree[2][1]))) if relex(tree[2][1]) else None]
-        elif tree[0] == "GotoITE":
-            cond = self.interpret_expr(parse_some_expr(relex(tree[2])))
-            if_label, else_label = tree[3], tree[4]
-            with self.trace.explain(relex(tree)):
-                cond_val = self.trace.emit(("*", cond)).cval()
-                # TODO: branch scheduling
-                if cond_val:
-                    self.emit("(assert (!= (* {0}) (imm {1})))", cond, 0)
-                    # TODO: Won't work if the same label exists in other functions...
-                    jump_to = [l for l in self.lexing.lexemes
-                               if l.string == if_label.string and l.next_lexeme().string == ":"]
-                    self.curr_lexeme = jump_to[0]
-                else:
-                    # TODO: Always taking the if branch...
-                    self.emit("(assert (== (* {0}) (imm {1})))", cond, 0)
-                    # TODO: Won't work if the same label exists in other functions...
-                    jump_to = [l for l in self.lexing.lexemes
-                               if l.string == else_label.string and l.next_lexeme().string == ":"]
-                    self.curr_lexeme = jump_to[0]
-        elif tree[0] == "Goto":
-            _, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "goto ...;", "goto_ite (1) {0} {0};")
-            self.curr_lexeme = new[0]
-        elif tree[0] == "For":
+        if macro["args"] is None:
+            to_replace = self.lexing.occurrences(macro["name"], lexemes[-1])
+            pattern = " ".join(macro["pattern"]).replace("{", "{{").replace("}", "}}")
+            for lexeme in to_replace:
+                self.lexing.rewrite([lexeme, lexeme], pattern)
+        else:
+            starts = [l for l in self.lexing.occurrences(macro["name"], lexemes[-1])
+                      if l.next_lexeme().string == "("]
+            for lexeme in starts:
+                all_lexemes, args = [lexeme, lexeme.next_lexeme()], [[]]
+                l = all_lexemes[-1]
+                depth = 0
+                while True:
+                    l = l.next_lexeme()
+                    all_lexemes.append(l)
+                    if l.string == "(": depth += 1
+                    if l.string == ")": depth -= 1
+                    if depth < 0: break
+                    if l.string == "," and depth == 0: args.append([])
+                    else:               args[-1].append(l)
+                pattern = macro["expand"](args)
+                self.lexing.rewrite(all_lexemes, pattern, dict({str(i): v for i, v in enumerate(args)}))
+        self.curr_lexeme = lexemes[-1].next_lexeme()
+        self.lexing.rewrite(lexemes, "")
+        return
+
+    def stmt_statement(self, tree):
+        """Unwraps a nested statement"""
+        return self.interpret(tree[1])
+
+    def stmt_label(self, tree):
+        """Steps past a label into the labeled statement"""
+        self.curr_lexeme = relex(tree[3])[0]
+
+    def stmt_return(self, tree):
+        """Evaluates the return value, if any"""
+        lexemes = relex(tree[2][1])
+        return ["return", self.interpret_expr(parse_some_expr(lexemes)) if lexemes else None]
+
+    def stmt_goto_ite(self, tree):
+        """Core branching instruction: goto_ite (cond) if_label else_label;"""
+        cond = self.interpret_expr(parse_some_expr(relex(tree[2])))
+        if_label, else_label = tree[3], tree[4]
+        with self.trace.explain(relex(tree)):
+            cond_val = self.trace.emit(("*", cond)).cval()
+            # TODO: branch scheduling; for now, opaque conditions always take
+            # the if branch.
+            taken = bool(cond_val)
+            self.emit(("(assert (== (* {0}) (imm {1})))",
+                       "(assert (!= (* {0}) (imm {1})))")[taken], cond, 0)
+            # TODO: Won't work if the same label exists in other functions...
+            label = (else_label, if_label)[taken]
+            self.curr_lexeme = self.lexing.find_label(label.string)
+
+    def stmt_goto(self, tree):
+        """Lowers goto to an unconditional goto_ite"""
+        _, new = self.lexing.fancy_rewrite(tree, self.trace,
+                "goto ...;", "goto_ite (1) {0} {0};")
+        self.curr_lexeme = new[0]
+
+    def stmt_for(self, tree):
+        """Lowers a for loop to labels and goto_ites"""
+        labels, new = self.lexing.fancy_rewrite(tree, self.trace,
+                "for (...; ...; ...) ...",
+                """{0}; goto [lchk]; [lupd]: {2};
+                   [lchk]: goto_ite ({1}) [lloop] [lend];
+                   [lloop]: {3} goto [lupd];
+                   [lend]: 0;""")
+        body = relex(tree)[1:]
+        self.replace_stmts(body, "Break", ("For", "While", "DoWhile", "Switch"),
+                           f"goto {labels['lend']}")
+        self.replace_stmts(body, "Continue", ("For", "While", "DoWhile"),
+                           f"goto {labels['lupd']}")
+        self.curr_lexeme = new[0]
+
+    def stmt_while(self, tree):
+        """Lowers a while loop to labels and an if"""
+        labels, new = self.lexing.fancy_rewrite(tree, self.trace,
+                "while (...) ...",
+                "[lchk]: if ({0}) {{ {1} goto [lchk]; }} [lend]: 0;")
+        body = relex(tree)[1:]
+        self.replace_stmts(body, "Break", ("For", "While", "DoWhile", "Switch"),
+                           f"goto {labels['lend']}")
+        self.replace_stmts(body, "Continue", ("For", "While", "DoWhile"),
+                           f"goto {labels['lchk']}")
+        self.curr_lexeme = new[0]
+
+    def stmt_if(self, tree):
+        """Lowers an if(/else) to labels and a goto_ite"""
+        if tree[-1][0] == "?": # Have an else branch
             labels, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "for (...; ...; ...) ...",
-                    """{0}; goto [lchk]; [lupd]: {2};
-                       [lchk]: goto_ite ({1}) [lloop] [lend];
-                       [lloop]: {3} goto [lupd];
-                       [lend]: 0;""")
-            self.replace_stmts(relex(tree)[1:], "Break", ("For", "While", "DoWhile", "Switch"),
-                               f"goto {labels['lend']}")
-            self.replace_stmts(relex(tree)[1:], "Continue", ("For", "While", "DoWhile"),
-                               f"goto {labels['lupd']}")
-            self.curr_lexeme = new[0]
-        elif tree[0] == "While":
+                "if (...) ... else ...",
+                """goto_ite ({0}) [lif] [lelse];
+                   [lif]: {{ {1} goto [lend]; }}
+                   [lelse]: {2}
+                   [lend]: 0;""")
+        else:
             labels, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "while (...) ...",
-                    "[lchk]: if ({0}) {{ {1} goto [lchk]; }} [lend]: 0;")
-            self.replace_stmts(relex(tree)[1:], "Break", ("For", "While", "DoWhile", "Switch"),
-                               f"goto {labels['lend']}")
-            self.replace_stmts(relex(tree)[1:], "Continue", ("For", "While", "DoWhile"),
-                               f"goto {labels['lchk']}")
-            self.curr_lexeme = new[0]
-        elif tree[0] == "IfStmt":
-            if tree[-1][0] == "?": # Have an else branch
-                labels, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "if (...) ... else ...",
-                    """goto_ite ({0}) [lif] [lelse];
-                       [lif]: {{ {1} goto [lend]; }}
-                       [lelse]: {2}
-                       [lend]: 0;""")
+                "if (...) ...",
+                "goto_ite ({0}) [lif] [lelse]; [lif]: {{ {1} }} [lelse]: 0;")
+        self.curr_lexeme = new[0]
+
+    def stmt_block(self, tree):
+        """Steps into a { ... } block"""
+        # TODO: Push scope
+        self.curr_lexeme = relex(tree[1][2])[0]
+
+    def stmt_end_block(self, tree):
+        """Steps out of a { ... } block"""
+        # TODO: Pop scope
+        self.curr_lexeme = relex(tree)[-1].next_lexeme()
+
+    def stmt_line(self, tree):
+        """Evaluates an expression statement"""
+        next_lexeme = relex(tree)[-1].next_lexeme()
+        tree = parse_some_expr(relex(tree[1][1]))
+        self.interpret_expr(tree)
+        self.curr_lexeme = next_lexeme
+
+    def stmt_switch(self, tree):
+        """Lowers a switch to labels and goto_ites"""
+        # Replace the switch itself.
+        labels, new = self.lexing.fancy_rewrite(tree, self.trace,
+            "switch (...) ...", "auto [val] = ({0}); goto [lend]; {{ {1} }} [lend]: 0;")
+        # Now, find goto [lend]. The new lexemes are contiguous in the lexing,
+        # so each one's successor is just the next entry of new.
+        insert_before = next(l for l, next_l in zip(new, new[1:])
+                             if l.string == "goto" and next_l.string == labels["lend"])
+        # Replace the breaks.
+        self.replace_stmts(relex(tree)[1:], "Break", ("For", "While", "DoWhile", "Switch"),
+                           f"goto {labels['lend']}")
+        # Rewrite cases into labels and goto_ites.
+        default_label = labels["lend"]
+        fallthrough_label, = self.trace.gen_labels(1)
+        for value, case_tree in find_cases(relex(tree[3][1][1][2])):
+            label = self.lexing.fancy_rewrite(case_tree, self.trace,
+                "...", "[label]:")[0]["label"]
+            if not value:
+                default_label = label
             else:
-                labels, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "if (...) ...",
-                    "goto_ite ({0}) [lif] [lelse]; [lif]: {{ {1} }} [lelse]: 0;")
-            self.curr_lexeme = new[0]
-        elif tree[0] == "Block":
-            # TODO: Push scope
-            self.curr_lexeme = relex(tree[1][2])[0]
-        elif tree[0] == "EndBlock":
-            # TODO: Pop scope
-            self.curr_lexeme = relex(tree)[-1].next_lexeme()
-        elif tree[0] == "Line":
-            next_lexeme = relex(tree)[-1].next_lexeme()
-            tree = parse_some_expr(relex(tree[1][1]))
-            self.interpret_expr(tree)
-            self.curr_lexeme = next_lexeme
-        elif tree[0] == "Switch":
-            # Replace the switch itself.
-            labels, new = self.lexing.fancy_rewrite(tree, self.trace,
-                "switch (...) ...", "auto [val] = ({0}); goto [lend]; {{ {1} }} [lend]: 0;")
-            # Now, find goto [lend]
-            insert_before = next(l for l in new
-                                 if l.string == "goto" and l.next_lexeme().string == labels["lend"])
-            # Replace the breaks.
-            self.replace_stmts(relex(tree)[1:], "Break", ("For", "While", "DoWhile", "Switch"),
-                               f"goto {labels['lend']}")
-            # Rewrite cases into labels and goto_ites.
-            default_label = labels["lend"]
-            fallthrough_label, = self.trace.gen_labels(1)
-            for value, case_tree in find_cases(relex(tree[3][1][1][2])):
-                label = self.lexing.fancy_rewrite(case_tree, self.trace,
-                    "...", "[label]:")[0]["label"]
-                if not value:
-                    default_label = label
-                else:
-                    next_label, = self.trace.gen_labels(1)
-                    self.lexing.prepend(insert_before,
-                        f"{fallthrough_label}: goto_ite ({labels['val']} == ({{value}})) {label} {next_label};",
-                        {"value": value})
-                    fallthrough_label = next_label
-            self.lexing.prepend(insert_before,
-                f"{fallthrough_label}: goto {default_label};")
-            self.curr_lexeme = new[0]
-        else:
-            print(tree)
-            raise NotImplementedError
+                next_label, = self.trace.gen_labels(1)
+                self.lexing.prepend(insert_before,
+                    f"{fallthrough_label}: goto_ite ({labels['val']} == ({{value}})) {label} {next_label};",
+                    {"value": value})
+                fallthrough_label = next_label
+        self.lexing.prepend(insert_before,
+            f"{fallthrough_label}: goto {default_label};")
+        self.curr_lexeme = new[0]
 
     def emit(self, pattern, *args):
         """Wrapper around Trace.emit
@@ -270,221 +372,293 @@ class Interpreter:
         call interpret_expr on the arguments [subtree foo()], etc., and produce
         the correct IR that Trace.emit can read.
         """
-        expr = parse_expr_str(pattern, True)
-        def visit(n):
-            if not isinstance(n, list): return
-            for i, arg in enumerate(n):
-                if arg[0] == "e" and arg[1] == "{" and arg[-1] == "}":
-                    n[i] = self.interpret_expr(parse_some_expr(relex(args[int(arg[2:-1])])))
-                elif n[i][0] == "{" and n[i][-1] == "}":
-                    n[i] = args[int(arg[1:-1])]
-                elif isinstance(arg, list):
-                    visit(arg)
-        visit(expr)
-        return self.trace.emit(expr)
+        return self.trace.emit(self.fill_template_(parse_expr_template(pattern),
+                                                   args))
+
+    def fill_template_(self, n, args):
+        """Substitutes @args into the parsed emit template @n"""
+        if isinstance(n, tuple):
+            kind, x = n
+            if kind == "const": return x
+            if kind == "e":
+                return self.interpret_expr(parse_some_expr(relex(args[x])))
+            return args[x]
+        if isinstance(n, list):
+            return [self.fill_template_(child, args) for child in n]
+        return n
 
     def interpret_expr(self, tree):
-        """Wrapper to interpret an expression"""
+        """Wrapper to interpret an expression
+
+        Parentheses and the left-hand sides of commas are peeled off in a loop
+        here rather than recursing through interpret_expr_. Only the innermost
+        explanation is ever visible to the values they produce, so skipping
+        the intermediate ones changes nothing.
+        """
+        while tree[0] in ("Parens", "Comma"):
+            if tree[0] == "Parens":
+                tree = parse_some_expr(relex(tree[1][2]))
+            else:
+                self.interpret_expr(parse_some_expr(relex(tree[1][1])))
+                tree = parse_some_expr(relex(tree[2]))
         with self.trace.explain(relex(tree)):
             return self.interpret_expr_(tree)
 
     def interpret_expr_(self, tree):
         """Interpreter for expressions"""
         # print("EXPR TREE:", tree)
-        if tree[0] == "Member":
-            return self.emit("(field e{0} (imm {1}))",
-                             tree[1][1], relex(tree)[-1].string)
-        elif tree[0] == "Comma":
-            lhs = self.interpret_expr(parse_some_expr(relex(tree[1][1])))
-            return self.interpret_expr(parse_some_expr(relex(tree[2])))
-        elif tree[0] == "Assign":
-            if tree[1][2].string != "=":
-                assert len(tree[1][2].string) == 2
-                op = tree[1][2].string[0]
-                # TODO: May double-execute some things?
-                _, new = self.lexing.fancy_rewrite(tree, self.trace,
-                        f"...{op}=...", f"(({{0}}) = (({{0}}) {op} ({{1}})))")
-                return self.interpret_expr(parse_some_expr(new))
-            lhs = relex(tree[1][1])
-            if lhs[0].label == "ident" and lhs[-1].string == "]" and not any(l.string in (".","->") for l in lhs) and lhs[1].string != "[": # TODO
-                # Interpret this as a declaration of an array?
-                open_bracket = lhs.index(next(l for l in lhs if l.string == "["))
-                lhs = lhs[open_bracket-1:open_bracket]
-            elif lhs[0].label == "ident" and lhs[-1].string == "]" and not any(l.string in (".","->") for l in lhs) and lhs[1].string == "[": # TODO
-                lhs = lhs
-            elif lhs[0].label == "ident" and not any(l.string in (".", "->") for l in lhs): # TODO
-                # Interpret this as a declaration?
-                lhs = lhs[-1:]
-            return self.emit("(upd (* e{0}) e{1})", tree[2][1], lhs)
-        elif tree[0] == "Inc":
-            # TODO: Pre- vs. Post-inc, also double-execute?
-            return self.emit("(upd (+ (imm {0}) (* e{1})) e{1})", 1, tree[1][1])
-        elif tree[0] == "Lits":
-            literals = tree[1:-1]
-            if all(l.label == "strlit" for l in relex(literals)):
-                return self.emit("(str (imm {0}))",
-                                 "".join([eval(l.string) for l in relex(literals)]))
-            if len(literals) != 1:
-                return self.interpret_expr(parse_some_expr(relex(tree)[-1:]))
-            if literals[0].label == "ident":
-                return self.trace.local(literals[0].string)
-            if literals[0].label == "numlit":
-                lit = literals[0].string
-                if all(c.isnumeric() for c in lit):
-                    return self.emit("(str (imm {0}))", int(lit))
-                return self.emit("(str (imm {0}))", eval(lit))
-            raise NotImplementedError
-        elif tree[0] == "pre_sizeof":
-            _, new = self.lexing.fancy_rewrite(tree, self.trace, "sizeof ...", "sizeof({0})")
-            return self.interpret_expr(parse_some_expr(new))
-        elif tree[0] == "pre_!":
-            _, new = self.lexing.fancy_rewrite(tree, self.trace, "! ...", "(({0}) == 0)")
-            return self.interpret_expr(parse_some_expr(new))
-        elif tree[0] == "pre_*":
-            return self.emit("(* e{0})", tree[2])
-        elif tree[0] == "pre_&":
-            return self.emit("(str e{0})", tree[2])
-        elif tree[0].startswith("pre_"):
-            return self.emit("(str ({0} (* e{1})))", tree[0][len("pre_"):], tree[2])
-        elif tree[0].startswith("bin_"):
-            return self.emit("(str ({0} (* e{1}) (* e{2})))", tree[0], tree[1][1], tree[2])
-        elif tree[0] == "Parens":
-            return self.interpret_expr(parse_some_expr(relex(tree[1][2])))
-        elif tree[0] == "InitList":
-            if any(l.string == "return" for l in relex(tree)):
-                self.trace.push_scope([], [])
-                self.curr_lexeme = relex(tree)[1]
-                while True:
-                    result = self.step()
-                    if isinstance(result, list) and result[0] == "return":
-                        self.trace.pop_scope()
-                        self.curr_lexeme = relex(tree)[-1].next_lexeme()
-                        return result[1]
-            fields = list(filter(None, parse_csv(relex(tree)[1:-1], ",")))
-            # TODO: something better, top-down
-            is_struct = any(f and f[0].string == "." for f in fields)
-            if is_struct:
-                new, label = ["(", "{"], self.trace.gen_labels(1)[0]
-                for field in fields:
-                    while len(field) > 1 and field[0].string.startswith("#"):
-                        field = field[1:]
-                    new += [label, field, ";"]
-                new += ["return", label, ";", "}", ")"]
-                new = self.lexing.rewrite(relex(tree), new)
-                # print(" ".join([l.string for l in new]))
-                return self.interpret_expr(parse_some_expr(new))
-            else: # parse an array
-                new, (label, countlabel) = ["(", "{"], self.trace.gen_labels(2)
-                new += [countlabel, "=", "0;"]
-                from framework.peg import PEG
-                peg = PEG()
-                peg.rule("Field", "(? (seq (balanced [ ]) (str =))) (skipto (! (.)))")
-                for field in fields:
-                    parsed, _ = peg.parse("(: Field)", field)
-                    if parsed[1][0] == "?":
-                        new += [countlabel, "=", "___ifconcr", "("] + relex(parsed[1])[1:-2] + [",", countlabel, ")", ";"]
-                    new += [label, "[", countlabel, "]", "="]
-                    new += relex(parsed[-1]) + [";", countlabel, "+=", "1", ";"]
-                new += ["return", label, ";", "}", ")"]
-                new = self.lexing.rewrite(relex(tree), new)
-                # print(" ".join([l.string for l in new]))
-                return self.interpret_expr(parse_some_expr(new))
-        elif tree[0] == "StructDecl":
-            # TODO: A bit sketchy with unnamed fields, but I don't think this
-            # is ever actually used anywhere so ...
-            fields = []
-            for field in parse_csv(relex(tree[-1])[1:-1], ";"):
-                if not field: continue
-                if field[-1].string == "}":
-                    type_ = field
-                    name = None
-                else:
-                    type_ = field[:-1]
-                    name = field[-1].string
-                if type_ and type_[0].string == "const":
-                    type_ = type_[1:]
-                if any(l.string == "{" for l in type_):
-                    type_ = self.interpret_expr(parse_some_expr(type_))
-                else:
-                    type_ = None
-                fields.append((name, type_))
-            # print(fields)
-            # TODO: Put it in memory, local ref to it
-            return fields
-        elif tree[0] == "UnionDecl":
-            return None
-        elif tree[0] == "EnumDecl":
-            options = []
-            count = 0
-            for field in parse_csv(relex(tree[-1])[1:-1], ","):
-                if not field: continue
-                name = field[0].string
-                if any(l.string == "=" for l in field):
-                    count = eval(field[-1].string)
-                options.append((name, count))
-                count = count + 1
-                # TODO: Maybe just insert #defines?
-                with self.trace.explain(relex(tree)):
-                    local = self.trace.local(name)
-                    self.emit("(upd (imm {0}) {1})", count - 1, local)
-            return self.emit("(str (imm {0}))", options)
-        elif tree[0] == "DerefMember":
+        handler = self.expr_handlers.get(tree[0])
+        if handler is None:
+            # Operators without a dedicated handler are dispatched by prefix;
+            # remember the result so the next lookup is a single dict hit.
+            if tree[0].startswith("pre_"):      handler = self.expr_pre_op
+            elif tree[0].startswith("bin_"):    handler = self.expr_bin_op
+            else:
+                print(tree)
+                raise NotImplementedError
+            self.expr_handlers[tree[0]] = handler
+        return handler(tree)
+
+    def expr_member(self, tree):
+        """foo.bar"""
+        return self.emit("(field e{0} (imm {1}))",
+                         tree[1][1], relex(tree)[-1].string)
+
+    def expr_assign(self, tree):
+        """foo = bar, and compound assignments like foo += bar"""
+        if tree[1][2].string != "=":
+            assert len(tree[1][2].string) == 2
+            op = tree[1][2].string[0]
+            # TODO: May double-execute some things?
             _, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "...->...", "(*({0})).{1}")
+                    f"...{op}=...", f"(({{0}}) = (({{0}}) {op} ({{1}})))")
             return self.interpret_expr(parse_some_expr(new))
-        elif tree[0] == "Nth":
-            _, new = self.lexing.fancy_rewrite(tree, self.trace,
-                    "...[...]", "(*(({0}) + ({1})))")
+        lhs = relex(tree[1][1])
+        if lhs[0].label == "ident" and lhs[-1].string == "]" and not any(l.string in (".","->") for l in lhs) and lhs[1].string != "[": # TODO
+            # Interpret this as a declaration of an array?
+            open_bracket = lhs.index(next(l for l in lhs if l.string == "["))
+            lhs = lhs[open_bracket-1:open_bracket]
+        elif lhs[0].label == "ident" and lhs[-1].string == "]" and not any(l.string in (".","->") for l in lhs) and lhs[1].string == "[": # TODO
+            lhs = lhs
+        elif lhs[0].label == "ident" and not any(l.string in (".", "->") for l in lhs): # TODO
+            # Interpret this as a declaration?
+            lhs = lhs[-1:]
+        return self.emit("(upd (* e{0}) e{1})", tree[2][1], lhs)
+
+    def expr_inc(self, tree):
+        """foo++"""
+        # TODO: Pre- vs. Post-inc, also double-execute?
+        return self.emit("(upd (+ (imm {0}) (* e{1})) e{1})", 1, tree[1][1])
+
+    def expr_lits(self, tree):
+        """Identifiers, string literals, and numeric literals"""
+        literals = tree[1:-1]
+        lexemes = relex(literals)
+        if all(l.label == "strlit" for l in lexemes):
+            return self.emit("(str (imm {0}))",
+                             "".join([parse_literal(l.string) for l in lexemes]))
+        if len(literals) != 1:
+            return self.interpret_expr(parse_some_expr(relex(tree)[-1:]))
+        if literals[0].label == "ident":
+            return self.trace.local(literals[0].string)
+        if literals[0].label == "numlit":
+            return self.emit("(str (imm {0}))", parse_literal(literals[0].string))
+        raise NotImplementedError
+
+    def expr_sizeof(self, tree):
+        """sizeof foo"""
+        _, new = self.lexing.fancy_rewrite(tree, self.trace, "sizeof ...", "sizeof({0})")
+        return self.interpret_expr(parse_some_expr(new))
+
+    def expr_not(self, tree):
+        """!foo"""
+        _, new = self.lexing.fancy_rewrite(tree, self.trace, "! ...", "(({0}) == 0)")
+        return self.interpret_expr(parse_some_expr(new))
+
+    def expr_deref(self, tree):
+        """*foo"""
+        return self.emit("(* e{0})", tree[2])
+
+    def expr_addr_of(self, tree):
+        """&foo"""
+        return self.emit("(str e{0})", tree[2])
+
+    def expr_pre_op(self, tree):
+        """Other prefix operators, e.g., -foo"""
+        return self.emit("(str ({0} (* e{1})))", tree[0][len("pre_"):], tree[2])
+
+    def expr_bin_op(self, tree):
+        """Binary operators, e.g., foo + bar"""
+        return self.emit("(str ({0} (* e{1}) (* e{2})))", tree[0], tree[1][1], tree[2])
+
+    def expr_init_list(self, tree):
+        """Struct and array initializers, { ... }"""
+        lexemes = relex(tree)
+        if any(l.string == "return" for l in lexemes):
+            self.trace.push_scope([], [])
+            self.curr_lexeme = lexemes[1]
+            while True:
+                result = self.step()
+                assert result is not DONE, "ran off the end of the file"
+                if isinstance(result, list) and result[0] == "return":
+                    self.trace.pop_scope()
+                    self.curr_lexeme = lexemes[-1].next_lexeme()
+                    return result[1]
+        fields = list(filter(None, parse_csv(lexemes[1:-1], ",")))
+        # TODO: something better, top-down
+        is_struct = any(f and f[0].string == "." for f in fields)
+        if is_struct:
+            new, label = ["(", "{"], self.trace.gen_labels(1)[0]
+            for field in fields:
+                while len(field) > 1 and field[0].string.startswith("#"):
+                    field = field[1:]
+                new += [label, field, ";"]
+            new += ["return", label, ";", "}", ")"]
+            new = self.lexing.rewrite(lexemes, new)
             # print(" ".join([l.string for l in new]))
             return self.interpret_expr(parse_some_expr(new))
-        elif tree[0] == "FnCall":
-            fn = tree[1][1]
-            args = parse_csv(relex(tree[1][2][1][2]))
-            # print(args, self.trace.scopes)
-            if self.is_globals_pass and len(self.trace.scopes) == 1 and len(relex(fn)) > 1:
-                # TODO: better detection of declarations vs. calls
-                return None
-            eval_args = [
-                self.interpret_expr(parse_some_expr(relex(arg)))
-                for arg in args
-            ]
-            fn_name = " ".join([l.string for l in relex(fn)])
-            if fn_name == "___ifconcr":
-                possible = self.emit("(* {0})", eval_args[0])
-                return eval_args[0 if possible.canonical.concrete else 1]
-            if fn_name in self.fn_handlers:
-                # TODO: Maybe we should be passing the lexemes themself? For
-                # pass-by-name or smth
-                return self.fn_handlers[fn_name](*eval_args)
-            if None in self.fn_handlers:
-                return self.fn_handlers[None](tree, relex(fn), *eval_args)
+        else: # parse an array
+            new, (label, countlabel) = ["(", "{"], self.trace.gen_labels(2)
+            new += [countlabel, "=", "0;"]
+            from framework.peg import PEG
+            peg = PEG()
+            peg.rule("Field", "(? (seq (balanced [ ]) (str =))) (skipto (! (.)))")
+            for field in fields:
+                parsed, _ = peg.parse("(: Field)", field)
+                if parsed[1][0] == "?":
+                    new += [countlabel, "=", "___ifconcr", "("] + relex(parsed[1])[1:-2] + [",", countlabel, ")", ";"]
+                new += [label, "[", countlabel, "]", "="]
+                new += relex(parsed[-1]) + [";", countlabel, "+=", "1", ";"]
+            new += ["return", label, ";", "}", ")"]
+            new = self.lexing.rewrite(lexemes, new)
+            # print(" ".join([l.string for l in new]))
+            return self.interpret_expr(parse_some_expr(new))
+
+    def expr_struct_decl(self, tree):
+        """struct foo { ... }"""
+        # TODO: A bit sketchy with unnamed fields, but I don't think this
+        # is ever actually used anywhere so ...
+        fields = []
+        for field in parse_csv(relex(tree[-1])[1:-1], ";"):
+            if not field: continue
+            if field[-1].string == "}":
+                type_ = field
+                name = None
+            else:
+                type_ = field[:-1]
+                name = field[-1].string
+            if type_ and type_[0].string == "const":
+                type_ = type_[1:]
+            if any(l.string == "{" for l in type_):
+                type_ = self.interpret_expr(parse_some_expr(type_))
+            else:
+                type_ = None
+            fields.append((name, type_))
+        # print(fields)
+        # TODO: Put it in memory, local ref to it
+        return fields
+
+    def expr_union_decl(self, tree):
+        """union foo { ... }"""
+        return None
+
+    def expr_enum_decl(self, tree):
+        """enum foo { ... }"""
+        options = []
+        count = 0
+        lexemes = relex(tree)
+        for field in parse_csv(relex(tree[-1])[1:-1], ","):
+            if not field: continue
+            name = field[0].string
+            if any(l.string == "=" for l in field):
+                count = parse_literal(field[-1].string)
+            options.append((name, count))
+            count = count + 1
+            # TODO: Maybe just insert #defines?
+            with self.trace.explain(lexemes):
+                local = self.trace.local(name)
+                self.emit("(upd (imm {0}) {1})", count - 1, local)
+        return self.emit("(str (imm {0}))", options)
+
+    def expr_deref_member(self, tree):
+        """foo->bar"""
+        _, new = self.lexing.fancy_rewrite(tree, self.trace,
+                "...->...", "(*({0})).{1}")
+        return self.interpret_expr(parse_some_expr(new))
+
+    def expr_nth(self, tree):
+        """foo[bar]"""
+        _, new = self.lexing.fancy_rewrite(tree, self.trace,
+                "...[...]", "(*(({0}) + ({1})))")
+        # print(" ".join([l.string for l in new]))
+        return self.interpret_expr(parse_some_expr(new))
+
+    def expr_fn_call(self, tree):
+        """foo(bar, baz)"""
+        fn = relex(tree[1][1])
+        if self.is_globals_pass and len(self.trace.scopes) == 1 and len(fn) > 1:
+            # TODO: better detection of declarations vs. calls
             return None
-        print(tree)
-        raise NotImplementedError
+        eval_args = [self.interpret_expr(arg)
+                     for arg in self.parse_args(relex(tree[1][2][1][2]))]
+        fn_name = fn[0].string if len(fn) == 1 else " ".join([l.string for l in fn])
+        if fn_name == "___ifconcr":
+            possible = self.emit("(* {0})", eval_args[0])
+            return eval_args[0 if possible.find().concrete else 1]
+        handler = self.fn_handlers.get(fn_name)
+        if handler is not None:
+            # TODO: Maybe we should be passing the lexemes themself? For
+            # pass-by-name or smth
+            return handler(*eval_args)
+        if None in self.fn_handlers:
+            return self.fn_handlers[None](tree, fn, *eval_args)
+        return None
+
+    def parse_args(self, lexemes):
+        """Splits call arguments @lexemes on commas and parses each one
+
+        A parse only depends on the lexemes themselves, so the result is
+        memoized for when the same call site is executed again.
+        """
+        key = tuple(lexemes)
+        if key not in self.fn_args_memo_:
+            self.fn_args_memo_[key] = [parse_some_expr(relex(arg))
+                                       for arg in parse_csv(lexemes)]
+        return self.fn_args_memo_[key]
 
     def returnify_fn(self, start_lexeme):
-        """Takes a function and appends a "return;" statement to its body"""
-        subtree, _ = PEG().parse("(balanced { })", start_lexeme.suffix(including_self=True))
+        """Takes a function and appends a "return;" statement to its body
+
+        Only the first call for a given @start_lexeme does any work; after
+        that the body is known to end in a return.
+        """
+        if start_lexeme in self.returnified_:
+            return
+        self.returnified_.add(start_lexeme)
+        lexing = start_lexeme.lexing
+        subtree, _ = PEG().parse_from("(balanced { })", lexing.lexemes,
+                                      lexing.index(start_lexeme))
         assert subtree
         if subtree[-3].string != "return":
             self.lexing.prepend(subtree[-1], "return ;")
 
     def default_fn_handler(self, tree, fn_lexemes, *args):
         """Handles a function call"""
-        if relex(tree)[0].string in self.verbose_fns:
+        lexemes = relex(tree)
+        if lexemes[0].string in self.verbose_fns:
             # If marked verbose, print the arguments
-            line_number = relex(tree)[0].line_number
-            formats = self.verbose_fns[relex(tree)[0].string]
+            line_number = lexemes[0].line_number
+            formats = self.verbose_fns[lexemes[0].string]
             try:
                 formatted = []
                 for a, fmt in zip(args, formats):
                     val = self.trace.emit(("*", a))
-                    if val.canonical.concrete:
+                    if val.find().concrete:
                         formatted.append(f"{val.cval():{fmt}}")
                     else:
                         formatted.append("[opaque value]")
                 print(f"Line {line_number}:",
-                        self.lexing.to_string(relex(tree)), "=>",
+                        self.lexing.to_string(lexemes), "=>",
                         ", ".join(formatted))
             except TypeError:
                 for a in args:
@@ -505,11 +679,12 @@ class Interpreter:
             self.curr_lexeme = start_lexeme
             while True:
                 result = self.step()
+                assert result is not DONE, "ran off the end of the file"
                 if isinstance(result, list) and result[0] == "return":
                     self.trace.pop_scope()
                     return result[1]
                 # TODO: void, or implicit-return functions? Maybe insert an
                 # explicit return statement at the end.
-            return self.trace.temp(["fneval", relex(tree)])
+            return self.trace.temp(["fneval", lexemes])
         # Otherwise, just assume it's opaque
         return self.trace.opaque()
@@ -7,10 +7,16 @@ represents the source code. When later stages do desugaring, etc., they do it
 directly on the Lexing object, which provides methods like fancy_rewrite(...)
 to assist with this.
 """
+import bisect
 import re
+import sys
 
 class Lexeme:
     """Represents a single lexeme in the file"""
+    # Files have many thousands of lexemes, which the interpreter scans over
+    # constantly; slots keep each one small and its attributes cheap to read.
+    __slots__ = ("lexing", "label", "start_idx", "end_idx", "pseudo", "string")
+
     def __init__(self, lexing, label, start_idx, length, pseudo_string=None):
         """Create a new Lexeme at the specified location in the file.
 
@@ -19,32 +25,52 @@ class Lexeme:
         from the file itself.
         """
         self.lexing = lexing
-        self.label = label
         self.start_idx = start_idx
         self.end_idx = start_idx + length
+        # Strings and labels are interned so the interpreter's many
+        # comparisons against constants like "(" or "return" usually
+        # short-circuit on identity, and so PEG can compare them with `is`.
+        self.label = sys.intern(label)
         if pseudo_string:
             self.pseudo = True
-            self.string = pseudo_string
+            self.string = sys.intern(pseudo_string)
         else:
             self.pseudo = False
-            self.string = lexing.full_string[start_idx:self.end_idx]
+            self.string = sys.intern(lexing.full_string[start_idx:self.end_idx])
+
+    @staticmethod
+    def make_pseudo(lexing, label, string, idx):
+        """Cheaply create a pseudo lexeme @string located at offset @idx
+
+        Used by rewrite for its new lexemes; unlike __init__, @string and
+        @label are taken as-is (they come from an existing, already-interned
+        lexeme).
+        """
+        self = Lexeme.__new__(Lexeme)
+        self.lexing = lexing
+        self.label = label
+        self.start_idx = idx
+        self.end_idx = idx + 1
+        self.pseudo = True
+        self.string = string
+        return self
 
     @property
     def line_number(self):
         """Line number in the original file"""
-        return 1 + self.lexing.full_string[:self.start_idx].count("\n")
+        return self.lexing.line_of(self.start_idx)
 
     def next_lexeme(self):
         """Next lexeme in the lexing"""
-        if self.lexing.lexemes[-1] == self:
+        if self.lexing.lexemes[-1] is self:
             return None
-        return self.lexing.lexemes[self.lexing.lexemes.index(self) + 1]
+        return self.lexing.lexemes[self.lexing.index(self) + 1]
 
     def suffix(self, including_self=False):
         """List all lexemes after(/including) @self"""
-        if self.lexing.lexemes[-1] == self:
+        if self.lexing.lexemes[-1] is self:
             return []
-        idx = self.lexing.lexemes.index(self)
+        idx = self.lexing.index(self)
         if not including_self:
             idx += 1
         return self.lexing.lexemes[idx:]
@@ -55,45 +81,183 @@ class Lexeme:
 
 class Lexing:
     """Represents a source file as a list of lexemes"""
-    def __init__(self, rules, full_string):
+    def __init__(self, rules, full_string, first_chars=None):
         """Initialize a lexing. Should only be called via Lexing.lex."""
         self.rules = rules
+        self.first_chars = first_chars
         self.full_string = full_string
         self.lexemes = []
+        # Maps lexeme -> (last known position in self.lexemes of its first
+        # occurrence, number of rewrites at the time); validated on use so
+        # rewrites never need to invalidate it. rewrite keeps it pointing at
+        # the first occurrence when it copies a lexeme in after that one.
+        self.index_memo_ = dict()
+        # (start, old end, change in length) of each splice rewrite made, so
+        # index can shift a stale position instead of searching for it.
+        self.splices_ = []
+        # Maps label name -> lexeme; rebuilt lazily after each rewrite.
+        self.labels_memo_ = None
+        # Maps string -> {lexeme: number of occurrences}; built lazily, then
+        # kept up to date by rewrite.
+        self.strings_memo_ = None
+        # Maps literal piece of a rewrite pattern -> its lexemes' labels and
+        # strings; see lex_literal_.
+        self.literals_memo_ = dict()
+        # Sorted offsets of the newlines in full_string; built lazily.
+        self.newlines_ = None
+        # Maps index -> statement parsed there, filled by
+        # miniparse.parse_lexing_cf; cleared by every rewrite.
+        self.stmt_memo = dict()
+
+    def index(self, lexeme):
+        """Position of @lexeme in self.lexemes
+
+        Equivalent to self.lexemes.index(lexeme), but remembers the answer so
+        repeated lookups (e.g., once per Interpreter.step) are O(1). After a
+        few rewrites, the remembered position is shifted past each splice
+        rather than searching the whole list again.
+        """
+        i, n_splices = self.index_memo_.get(lexeme, (None, None))
+        if i is not None and len(self.splices_) - n_splices <= 32:
+            for start, end, delta in self.splices_[n_splices:]:
+                if i >= end:
+                    i += delta
+                elif i >= start:
+                    i = None
+                    break
+        if i is None or i >= len(self.lexemes) or self.lexemes[i] is not lexeme:
+            # Refresh every position at once, so the lexemes around this one
+            # (which are usually looked up next) are fresh too. Going in
+            # reverse leaves the first occurrence of each, as list.index does.
+            now = len(self.splices_)
+            for j in reversed(range(len(self.lexemes))):
+                self.index_memo_[self.lexemes[j]] = (j, now)
+            i, n_splices = self.index_memo_.get(lexeme, (None, None))
+            if n_splices != now:
+                # Not in self.lexemes at all; raise as list.index would.
+                i = self.lexemes.index(lexeme)
+        self.index_memo_[lexeme] = (i, len(self.splices_))
+        return i
+
+    def find_label(self, name):
+        """First lexeme @name that is immediately followed by a ":"
+
+        Used to resolve goto targets without rescanning the whole file on
+        every jump.
+        """
+        if self.labels_memo_ is None:
+            self.labels_memo_ = dict()
+            for lexeme, next_lexeme in zip(self.lexemes, self.lexemes[1:]):
+                if next_lexeme.string == ":":
+                    self.labels_memo_.setdefault(lexeme.string, lexeme)
+        return self.labels_memo_[name]
+
+    def occurrences(self, string, after=None):
+        """All lexemes @string (strictly after @after), in file order
+
+        Uses an inverted index so callers like macro expansion only visit the
+        candidate sites rather than scanning the rest of the file.
+        """
+        if self.strings_memo_ is None:
+            self.strings_memo_ = dict()
+            for lexeme in self.lexemes:
+                self.count_string_(lexeme, 1)
+        candidates = self.strings_memo_.get(string)
+        if not candidates:
+            return []
+        start = -1 if after is None else self.index(after)
+        found = []
+        for lexeme, count in candidates.items():
+            i = self.index(lexeme)
+            if i > start:
+                found.extend([(i, lexeme)] * count)
+        found.sort(key=lambda pair: pair[0])
+        return [lexeme for _, lexeme in found]
+
+    def count_string_(self, lexeme, delta):
+        """Adjust the occurrence count of @lexeme in the strings_memo_"""
+        counts = self.strings_memo_.setdefault(lexeme.string, dict())
+        counts[lexeme] = counts.get(lexeme, 0) + delta
+        if not counts[lexeme]:
+            del counts[lexeme]
+
+    def newline_offsets_(self):
+        """Sorted offsets of the newlines in full_string"""
+        if self.newlines_ is None:
+            self.newlines_ = [m.start()
+                              for m in re.finditer("\n", self.full_string)]
+        return self.newlines_
+
+    def line_of(self, idx):
+        """Line number of the character at offset @idx in full_string"""
+        return 1 + bisect.bisect_left(self.newline_offsets_(), idx)
 
     def to_string(self, lexemes):
         """Lexeme range -> original string"""
         return self.full_string[lexemes[0].start_idx:lexemes[-1].end_idx]
 
-    # TODO: this is terrible, use lex to get O(N) instead of O(N^2)
     @staticmethod
-    def lex(rules, string):
+    def lex(rules, string, first_chars=None):
         """Lex an input file with the given rules.
 
         @rules is a dict of {token_label: regex_str} entries. If token_label
         begins with an underscore, it is treated as a comment/whitespace token
         and not included in the final lexing. Returns a Lexing object.
+
+        @first_chars optionally maps token labels to a string of every
+        character a (non-empty) match of that rule can start with. At each
+        offset, rules that cannot start with the current character are not
+        tried at all; rules missing from @first_chars are always tried.
+
+        Each rule is matched in place at the current offset, rather than
+        against a fresh slice of the remaining input, so lexing is linear in
+        the size of @string. A leading ^ in a rule is dropped, as it always
+        held at the start of the old slices.
         """
-        self = Lexing(rules, string)
-        compiled = [(name, re.compile(rule, re.DOTALL))
-                    for name, rule in rules.items()]
+        self = Lexing(rules, string, first_chars)
+        always, by_char = Lexing.compile_rules_(rules, first_chars)
         start_idx = 0
-        while string:
+        while start_idx < len(string):
             longest_name, longest_len = None, 0
-            for name, prog in compiled:
-                result = prog.match(string)
-                assert not result or result.start() == 0
-                if result and longest_len < result.end():
-                    longest_len = result.end()
+            for name, prog in by_char.get(string[start_idx], always):
+                result = prog.match(string, start_idx)
+                if result and longest_len < result.end() - start_idx:
+                    longest_len = result.end() - start_idx
                     longest_name = name
             assert longest_len
             if longest_name[0] != "_":
                 self.lexemes.append(
                     Lexeme(self, longest_name, start_idx, longest_len))
             start_idx += longest_len
-            string = string[longest_len:]
         return self
 
+    # Maps id(rules) -> (rules, first_chars, compiled scanner), so rule sets
+    # that live for the whole run (like C_RULES) are only compiled once.
+    compiled_rules_memo_ = dict()
+    @staticmethod
+    def compile_rules_(rules, first_chars):
+        """Compiles @rules into the scanner tables used by Lexing.lex
+
+        Returns the rules to try at characters missing from @first_chars, and
+        a dict mapping every other character to the rules to try there.
+        """
+        memo = Lexing.compiled_rules_memo_.get(id(rules))
+        if memo and memo[0] is rules and memo[1] is first_chars:
+            return memo[2]
+        compiled = [(name, re.compile(rule[1:] if rule[0] == "^" else rule,
+                                      re.DOTALL))
+                    for name, rule in rules.items()]
+        first = first_chars or dict()
+        always = [(name, prog) for name, prog in compiled
+                  if name not in first]
+        by_char = dict()
+        for c in set("".join(first.values())):
+            by_char[c] = [(name, prog) for name, prog in compiled
+                          if name not in first or c in first[name]]
+        Lexing.compiled_rules_memo_[id(rules)] = \
+            (rules, first_chars, (always, by_char))
+        return always, by_char
+
     def rewrite(self, old_range, pattern, substitutions=None, inclusive=True):
         """Core rewriter module.
 
@@ -127,48 +291,81 @@ class Lexing:
             return self.rewrite(old_range, new_pattern,
                                 substitutions, inclusive)
 
-        # Parse the pattern string.
-        parts = Lexing.lex(dict({
-            "Literal": "([{][{])|([}][}])",
-            "String": r"[^{}]*",
-            "Sub": r"[{][^{}]*?[}]",
-        }), pattern).lexemes
-        # Fill in the pattern string to identify what the new lexemes to fill
-        # in are.
+        # Fill in the (pre-parsed) pattern string to identify what the new
+        # lexemes to fill in are.
         new_lexemes = []
-        for part in parts:
-            if part.label == "Literal":
-                part.label = "String"
-                part.string = part.string[0]
-
-            if (part.label == "Sub"
-                    and isinstance(substitutions[part.string[1:-1]], str)):
-                part.label = "String"
-                part.string = substitutions[part.string[1:-1]]
-
-            if part.label == "String":
-                lexed = Lexing.lex(self.rules, part.string).lexemes
+        substituted = []
+        for label, string in rewrite_pattern_parts(pattern):
+            if label == "Sub" and isinstance(substitutions[string[1:-1]], str):
+                label, string = "String", substitutions[string[1:-1]]
+
+            if label == "String" and not string.strip():
+                # List patterns put a space before every entry; whitespace
+                # never produces lexemes, so don't even look it up.
+                continue
+            if label == "String":
                 idx = old_range[-1].start_idx
                 if new_lexemes:
                     idx = new_lexemes[-1].start_idx
-                for lex in lexed:
-                    lex.start_idx = idx
-                    lex.end_idx = idx + 1
-                new_lexemes.extend(lexed)
-            elif part.label == "Sub":
-                new_lexemes.extend(substitutions[part.string[1:-1]])
+                new_lexemes.extend(Lexeme.make_pseudo(self, lex_label, lex_string, idx)
+                                   for lex_label, lex_string
+                                   in self.lex_literal_(string))
+            elif label == "Sub":
+                new_lexemes.extend(substitutions[string[1:-1]])
+                substituted.extend(substitutions[string[1:-1]])
         # Then actually do the replacement in the list of lexemes.
         start = old_range[0]
         end = old_range[-1]
         if inclusive:
             end = end.next_lexeme()
-        prefix = self.lexemes[:self.lexemes.index(start)]
-        suffix = self.lexemes[self.lexemes.index(end):]
-        self.lexemes = prefix + new_lexemes + suffix
+        start_i, end_i = self.index(start), self.index(end)
+        # A substituted lexeme may already occur before the splice, in which
+        # case that (unmoved) occurrence stays the first one.
+        earlier = dict()
+        for lex in substituted:
+            if lex.lexing is self and lex not in earlier:
+                try:
+                    i = self.index(lex)
+                except ValueError:
+                    continue
+                if i < start_i:
+                    earlier[lex] = i
+        if self.strings_memo_ is not None:
+            for lex in self.lexemes[start_i:end_i]:
+                self.count_string_(lex, -1)
+            for lex in new_lexemes:
+                self.count_string_(lex, 1)
+        # Splice in place rather than building prefix + new + suffix, which
+        # would copy the whole file's lexemes twice per rewrite.
+        self.lexemes[start_i:end_i] = new_lexemes
+        self.stmt_memo.clear()
+        self.splices_.append((start_i, end_i,
+                              len(new_lexemes) - (end_i - start_i)))
+        self.labels_memo_ = None
         for lex in new_lexemes:
             lex.lexing = self
+        # Record where the new lexemes landed; if one appears more than once,
+        # the first occurrence wins, as with list.index.
+        for i in reversed(range(len(new_lexemes))):
+            self.index_memo_[new_lexemes[i]] = (start_i + i, len(self.splices_))
+        for lex, i in earlier.items():
+            self.index_memo_[lex] = (i, len(self.splices_))
         return new_lexemes
 
+    def lex_literal_(self, string):
+        """Lexes a literal piece of a rewrite pattern, memoized
+
+        The same pieces (";", "goto", ...) show up in many rewrites. Returns a
+        list of (label, string) pairs, from which rewrite makes fresh pseudo
+        lexemes each time.
+        """
+        if string not in self.literals_memo_:
+            self.literals_memo_[string] = [
+                (lexeme.label, lexeme.string)
+                for lexeme in Lexing.lex(self.rules, string,
+                                         self.first_chars).lexemes]
+        return self.literals_memo_[string]
+
     def fancy_rewrite(self, tree, trace, old_pattern, new_pattern):
         """Similar to rewrite, except bases substitutions on existing parse
 
@@ -181,12 +378,35 @@ class Lexing:
         from framework.peg import filterlex, relex
         tree = filterlex(tree)
         old_range = relex(tree)
+        old_pattern, label_names, new_pattern = \
+            compile_fancy_patterns(old_pattern, new_pattern)
         # Find pieces from the old pattern. The basic idea is to walk the tree,
         # looking for the first subtree that match the ....
         # TODO: These operations are a bit unnecessarily confusing; worth
         # rewriting.
-        old_pattern = old_pattern.replace("...", " ... ").split(" ")
-        old_pattern = [x for x in old_pattern if x]
+        # After filterlex, every node is a non-empty list, so the first lexeme
+        # and "is this a single lexeme" can be read off the left spine without
+        # flattening the whole subtree.
+        def first_lexeme(subtree):
+            """Equivalent to relex(subtree)[0]"""
+            while isinstance(subtree, list):
+                subtree = subtree[0]
+            return subtree
+        def single_lexeme(subtree):
+            """Equivalent to len(relex(subtree)) == 1"""
+            while isinstance(subtree, list):
+                if len(subtree) != 1:
+                    return False
+                subtree = subtree[0]
+            return True
+        # Both helpers below walk down the leftmost spine iteratively,
+        # remembering the right siblings at each level in @path, then rebuild
+        # the stripped tree bottom-up with reattach.
+        def reattach(remainder, path):
+            """Re-add the right siblings in @path around @remainder"""
+            for siblings in reversed(path):
+                remainder = [x for x in [remainder] + siblings if x]
+            return remainder
         def lsa(subtree, string):
             """Form a new tree left-stripping @string
 
@@ -194,12 +414,13 @@ class Lexing:
             parse tree and remove (with this function) the first subtree that
             corresponds to "if".
             """
-            assert not isinstance(subtree, Lexeme)
-            relexed = relex(subtree)
-            if len(relexed) == 1 and relexed[0].string == string:
-                return []
-            remainder = lsa(subtree[0], string)
-            return list(filter(None, [remainder] + subtree[1:]))
+            path = []
+            while True:
+                assert not isinstance(subtree, Lexeme)
+                if single_lexeme(subtree) and first_lexeme(subtree).string == string:
+                    return reattach([], path)
+                path.append(subtree[1:])
+                subtree = subtree[0]
         def lsa_suffix(subtree, string):
             """Left-strip a tree until we see @string
 
@@ -208,13 +429,15 @@ class Lexing:
             """
             if string is None:
                 return relex(subtree), []
-            if isinstance(subtree, Lexeme):
-                raise NotImplementedError
-            for i, child in enumerate(subtree):
-                if relex(child)[0].string == string:
-                    return relex(subtree[:i]), subtree[i:]
-            lexemes, remainder = lsa_suffix(subtree[0], string)
-            return lexemes, list(filter(None, [remainder] + subtree[1:]))
+            path = []
+            while True:
+                if isinstance(subtree, Lexeme):
+                    raise NotImplementedError
+                for i, child in enumerate(subtree):
+                    if first_lexeme(child).string == string:
+                        return relex(subtree[:i]), reattach(subtree[i:], path)
+                path.append(subtree[1:])
+                subtree = subtree[0]
         # For a pattern like if (...) ..., we use lsa to strip off a
         # leftmost-subtree for "if", then for "(", then lsa_suffix to read
         # subtrees until we see a ")", etc.
@@ -228,11 +451,7 @@ class Lexing:
 
         # Anywhere we see [label] in the @new_pattern, we need to generate a
         # fresh label and insert it.
-        labels = [x[1:-1]
-                  for x in sorted(set(re.findall(r"\[.*?\]", new_pattern)))]
-        labels = dict(zip(labels, trace.gen_labels(len(labels))))
-        for label in labels:
-            new_pattern = new_pattern.replace(f"[{label}]", "{" + label + "}")
+        labels = dict(zip(label_names, trace.gen_labels(len(label_names))))
         labels.update(dict({
             str(i): piece for i, piece in enumerate(pieces)
         }))
@@ -243,25 +462,96 @@ class Lexing:
         return self.rewrite([before], pattern, substitutions, inclusive=False)
 
     def after_line_number(self, line_number):
-        """Returns all lexemes after a given line number"""
-        return [l for l in self.lexemes if l.line_number >= line_number]
+        """Returns all lexemes after a given line number
+
+        Compares offsets against the start of @line_number rather than
+        computing every lexeme's line number. Lexemes moved by rewrites need
+        not be in offset order, so this filters rather than bisecting.
+        """
+        if line_number <= 1:
+            return list(self.lexemes)
+        newlines = self.newline_offsets_()
+        if line_number - 2 >= len(newlines):
+            return []
+        line_start = newlines[line_number - 2] + 1
+        return [l for l in self.lexemes if l.start_idx >= line_start]
+
+REWRITE_PATTERN_MEMO = dict()
+# Escaped braces, {substitutions}, and the literal text between them. These
+# never overlap, so leftmost-first matching agrees with Lexing.lex's
+# longest-match rule.
+REWRITE_PATTERN_PART = re.compile(
+    r"(?P<Literal>[{][{]|[}][}])|(?P<Sub>[{][^{}]*[}])|(?P<String>[^{}]+)")
+def rewrite_pattern_parts(pattern):
+    """Splits a rewrite pattern into its parts, memoized
+
+    Returns a list of ("String", literal) and ("Sub", "{name}") pairs, with
+    escaped braces already turned into literal strings.
+    """
+    if pattern not in REWRITE_PATTERN_MEMO:
+        parts, end = [], 0
+        for match in REWRITE_PATTERN_PART.finditer(pattern):
+            assert match.start() == end
+            end = match.end()
+            if match.lastgroup == "Literal":
+                parts.append(("String", match.group()[0]))
+            else:
+                parts.append((match.lastgroup, match.group()))
+        assert end == len(pattern)
+        REWRITE_PATTERN_MEMO[pattern] = parts
+    return REWRITE_PATTERN_MEMO[pattern]
+
+FANCY_PATTERNS_MEMO = dict()
+def compile_fancy_patterns(old_pattern, new_pattern):
+    """Does the string processing of fancy_rewrite's patterns, memoized
+
+    Call sites pass the same constant patterns every time, so this only runs
+    once per pattern pair. Returns the tokens of @old_pattern, the names of
+    the [label]s in @new_pattern, and @new_pattern with each [label] turned
+    into a {label} substitution.
+    """
+    key = (old_pattern, new_pattern)
+    if key not in FANCY_PATTERNS_MEMO:
+        old_tokens = old_pattern.replace("...", " ... ").split(" ")
+        old_tokens = [x for x in old_tokens if x]
+        labels = [x[1:-1]
+                  for x in sorted(set(re.findall(r"\[.*?\]", new_pattern)))]
+        for label in labels:
+            new_pattern = new_pattern.replace(f"[{label}]", "{" + label + "}")
+        FANCY_PATTERNS_MEMO[key] = (old_tokens, labels, new_pattern)
+    return FANCY_PATTERNS_MEMO[key]
 
+C_RULES = dict({
+    "preproc": r'^#[a-zA-Z_]+([\\][\n]|[^\n])*?\n',
+    "op": r"[\-][>]|\+\+|<<|>>|--|==|&&|[<>!+\-*/&|](=?)|[,(){};.=:&|~%?]|\[|\]|\^",
+    "ident": "[a-zA-Z_][a-zA-Z0-9_]*",
+    "strify": r'#[a-zA-Z_]+',
+    "pasteify": r'##[a-zA-Z_]+',
+    "numlit": "(0x[0-9a-fA-F]*)|([0-9]*)",
+    "strlit": r'["]([\\]["]|[^"][^"])*[^"]?["]',
+    "chrlit": r"[']([\\][']|[^'][^'])*[^']?[']",
+    "_slc": r'//[^\n]*',
+    "_mlc": r'/[*][^*]*[*]+([^/*][^*]*[*]+)*/',
+    "_space": r"\s",
+})
+# Characters each C rule's matches can start with; see Lexing.lex.
+C_FIRST_CHARS = dict({
+    "preproc": "#",
+    "op": "-+<>=&!*/|,(){};.:~%?[]^",
+    "ident": "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_",
+    "strify": "#",
+    "pasteify": "#",
+    "numlit": "0123456789",
+    "strlit": '"',
+    "chrlit": "'",
+    "_slc": "/",
+    "_mlc": "/",
+})
 def lex_c(string):
     """C lexer"""
-    return Lexing.lex({
-        "preproc": r'^#[a-zA-Z_]+([\\][\n]|[^\n])*?\n',
-        "op": r"[\-][>]|\+\+|<<|>>|--|==|&&|[<>!+\-*/&|](=?)|[,(){};.=:&|~%?]|\[|\]|\^",
-        "ident": "[a-zA-Z_][a-zA-Z0-9_]*",
-        "strify": r'#[a-zA-Z_]+',
-        "pasteify": r'##[a-zA-Z_]+',
-        "numlit": "(0x[0-9a-fA-F]*)|([0-9]*)",
-        "strlit": r'["]([\\]["]|[^"][^"])*[^"]?["]',
-        "chrlit": r"[']([\\][']|[^'][^'])*[^']?[']",
-        "_slc": r'//[^\n]*',
-        "_mlc": r'/[*]((?![*]/).)*[*]/',
-        "_space": r"\s",
-    }, string)
+    return Lexing.lex(C_RULES, string, C_FIRST_CHARS)
 
 def path_to_string(path):
     """Helper to read a file"""
-    return "".join(open(path, "r").readlines())
+    with open(path, "r") as f:
+        return f.read()
@@ -3,7 +3,8 @@
 The expression grammar was originally based off of
 https://github.com/pointlander/peg/blob/master/grammars/c/c.peg
 """
-from framework.peg import PEG, relex
+import ast
+from framework.peg import PEG, relex, parse_expr_str, skipto_visits, RELEX_MEMO
 
 def parse_some_cf(lexemes):
     """Parser C control flow with as many holes as possible.
@@ -16,8 +17,31 @@ def parse_some_cf(lexemes):
     that can probably be improved (e.g., skip to a ;).
 
     Notably, though, this is still extremely simple to extend --- just add a
-    new syntactic construct to the list in peg.rule("Statement").
+    new syntactic construct to the list in peg.rule("Statement") in
+    cf_grammar.
     """
+    return cf_peg.parse("(: Statement)", lexemes)
+
+def parse_some_cf_at(lexemes, pos):
+    """Like parse_some_cf on @lexemes[@pos:], but without copying @lexemes
+
+    Returns (tree, index just past the statement), or (False, @pos).
+    """
+    return cf_peg.parse_from("(: Statement)", lexemes, pos)
+
+def parse_lexing_cf(lexing, pos):
+    """parse_some_cf_at(@lexing.lexemes, @pos), memoized
+
+    The interpreter parses the same statements again on every loop iteration
+    or function call. A parse depends only on the lexemes, which only change
+    through Lexing.rewrite, and rewrite clears the memo.
+    """
+    if pos not in lexing.stmt_memo:
+        lexing.stmt_memo[pos] = parse_some_cf_at(lexing.lexemes, pos)
+    return lexing.stmt_memo[pos]
+
+def cf_grammar():
+    """Builds the PEG used by parse_some_cf"""
     peg = PEG()
 
     peg.rule("Block", "(balanced { })")
@@ -49,8 +73,14 @@ def parse_some_cf(lexemes):
 
     peg.rule("Statement", "(/ (: IfStmt) (: DoWhile) (: While) (: For) (: Switch) (: Case) (: Label) (: Goto) (: GotoITE) (: Break) (: Continue) (: Return) (: Block) (: EndBlock) (: Preproc) (: Function) (: Line))")
 
-    return peg.parse("(: Statement)", lexemes)
+    return peg
+
+# Built once; PEG.parse only keeps per-parse state while it is running.
+cf_peg = cf_grammar()
 
+# Maps tuple of lexemes -> parse tree. Parses only depend on the lexemes'
+# strings and labels, which never change, and trees are never mutated.
+expr_memo = dict()
 def parse_some_expr(lexemes):
     """Parses a C expression (with holes)
 
@@ -67,91 +97,132 @@ def parse_some_expr(lexemes):
     here...But, again, the goal is to be "good enough for most code," not
     "perfect."
     """
-    def try_parse(name, rule):
-        """If a solution has not been found, try parsing against @rule"""
-        if try_parse.solution is not None:
-            return
-        peg = PEG()
-        peg.rule("End", "(! (.))")
-        peg.rule(name, rule)
-        tree, remainder = peg.parse(f"(: {name})", lexemes)
-        if tree is not False and not remainder:
-            try_parse.solution = tree
-    try_parse.solution = None
-
-    try_parse("Parens", "(balanced) (: End)")
-    try_parse("Lits", "(/ (:: ident) (:: strlit) (:: numlit)) (? (: Lits)) (: End)")
-
-    try_parse("Comma", "(skipto (str ,)) (skipto (: End))")
+    key = tuple(lexemes)
+    if key not in expr_memo:
+        expr_memo[key] = None
+        # Most alternatives skipto an operator first; one walk over the
+        # lexemes tells us which of those can't possibly match.
+        visited = skipto_visits(lexemes)
+        for start, peg, needs in expr_rules:
+            if needs is not None and visited.isdisjoint(needs):
+                continue
+            # parse_from reports where the match ended, so seeing whether it
+            # consumed everything doesn't need the remainder sliced off.
+            tree, end = peg.parse_from(start, lexemes, 0)
+            if tree is not False and end == len(lexemes):
+                expr_memo[key] = tree
+                # Every lexeme the parse consumed is in the tree, and it
+                # consumed them all; expr_memo keeps the tree alive.
+                RELEX_MEMO[id(tree)] = (tree, key)
+                break
+    return expr_memo[key]
+
+# The alternatives parse_some_expr tries, in order; each is a (start
+# expression, single-rule PEG, PEG.skipto_strings of the rule) triple built
+# once at import time.
+expr_rules = []
+def expr_rule(name, rule):
+    """Adds @rule, labeled @name, as the next alternative to try"""
+    peg = PEG()
+    peg.rule("End", "(! (.))")
+    peg.rule(name, rule)
+    expr_rules.append((parse_expr_str(f"(: {name})"), peg,
+                       peg.skipto_strings(name)))
+
+def register_expr_rules():
+    """Registers parse_some_expr's alternatives, in precedence order"""
+    expr_rule("Parens", "(balanced) (: End)")
+    expr_rule("Lits", "(/ (:: ident) (:: strlit) (:: numlit)) (? (: Lits)) (: End)")
+
+    expr_rule("Comma", "(skipto (str ,)) (skipto (: End))")
 
     assignops = " ".join(f"(str {op})" for op in "=,*=,/=,%=,+=,-=,<<=,>>=,&=,^=,|=".split(","))
-    try_parse("Assign", f"(skipto (/ {assignops})) (skipto (: End))")
+    expr_rule("Assign", f"(skipto (/ {assignops})) (skipto (: End))")
 
     # TODO: Does this actually work if we have multiple ? Maybe skiptolast ?
-    try_parse("Cond", "(skipto (str ?)) (skipto (str :)) (skipto (: End))")
-
-    try_parse("Cast", "(balanced) (& (.)) (/ (& (balanced { })) (! (/ (:: op)))) (skipto (: End))")
+    expr_rule("Cond", "(skipto (str ?)) (skipto (str :)) (skipto (: End))")
 
-    ops = reversed("*,/,%,+,-,<<,>>,<,>,<=,>=,==,!=,|=,&=,&,^,|,&&,||".split(","))
-    for op in ops:
-        try_parse(f"bin_{op}", f"(! (str {op})) (skipto (str {op})) (skipto (: End))")
+    expr_rule("Cast", "(balanced) (& (.)) (/ (& (balanced { })) (! (/ (:: op)))) (skipto (: End))")
 
-    unary_ops = "+,-,++,--,!,~,*,&".split(",")
-    for op in unary_ops:
-        try_parse(f"pre_{op}", f"(str {op}) (skipto (: End))")
-    try_parse("pre_sizeof", "(str sizeof) (! (lparen)) (skipto (: End))")
+    for op in reversed("*,/,%,+,-,<<,>>,<,>,<=,>=,==,!=,|=,&=,&,^,|,&&,||".split(",")):
+        expr_rule(f"bin_{op}", f"(! (str {op})) (skipto (str {op})) (skipto (: End))")
 
-    try_parse("Nth", "(skipto (balanced [ ]) (: End))")
-    try_parse("Member", "(skipto (str .) (:: ident) (: End))")
-    try_parse("DerefMember", "(skipto (str ->) (:: ident) (: End))")
-    try_parse("Inc", "(skipto (str ++) (: End))")
-    try_parse("Dec", "(skipto (str ++) (: End))")
-    try_parse("FnCall", "(! (balanced)) (skipto (balanced) (: End))")
+    for op in "+,-,++,--,!,~,*,&".split(","):
+        expr_rule(f"pre_{op}", f"(str {op}) (skipto (: End))")
+    expr_rule("pre_sizeof", "(str sizeof) (! (lparen)) (skipto (: End))")
 
-    try_parse("Parens", "(balanced)")
+    expr_rule("Nth", "(skipto (balanced [ ]) (: End))")
+    expr_rule("Member", "(skipto (str .) (:: ident) (: End))")
+    expr_rule("DerefMember", "(skipto (str ->) (:: ident) (: End))")
+    expr_rule("Inc", "(skipto (str ++) (: End))")
+    expr_rule("Dec", "(skipto (str ++) (: End))")
+    expr_rule("FnCall", "(! (balanced)) (skipto (balanced) (: End))")
 
-    try_parse("StructDecl", "(str struct) (? (:: ident)) (balanced { })")
-    try_parse("UnionDecl", "(str union) (? (:: ident)) (balanced { })")
-    try_parse("EnumDecl", "(str enum) (? (:: ident)) (balanced { })")
+    expr_rule("Parens", "(balanced)")
 
-    try_parse("InitList", "(balanced { })")
+    expr_rule("StructDecl", "(str struct) (? (:: ident)) (balanced { })")
+    expr_rule("UnionDecl", "(str union) (? (:: ident)) (balanced { })")
+    expr_rule("EnumDecl", "(str enum) (? (:: ident)) (balanced { })")
 
-    return try_parse.solution
+    expr_rule("InitList", "(balanced { })")
+register_expr_rules()
 
+# Maps separator -> the PEG parse_csv uses to split on it
+csv_pegs = dict()
 def parse_csv(lexemes, comma=","):
     """"foo, bar" -> ["foo", "bar"]"""
-    peg = PEG()
-    peg.rule("Val", f"(skipto (str {comma})) (? (: Val))")
-    tree, remainder = peg.parse("(: Val)", lexemes)
+    if comma not in csv_pegs:
+        csv_pegs[comma] = PEG()
+        csv_pegs[comma].rule("Val", f"(skipto (str {comma})) (? (: Val))")
+    tree, remainder = csv_pegs[comma].parse("(: Val)", lexemes)
     if remainder is False:
         return [lexemes] if lexemes else []
-    def visit(node):
-        if not isinstance(node, list): return []
+    values, stack = [], [tree]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, (list, tuple)) or not node: continue
         if node[0] == "skipto":
-            return [node[1]]
-        result = []
-        for sub in node:
-            result.extend(visit(sub))
-        return result
-    return visit(tree) + [remainder]
+            values.append(node[1])
+        else:
+            stack.extend(reversed(node))
+    return values + [remainder]
+
+literal_memo = dict()
+def parse_literal(string):
+    """Python value of a numeric or string literal, memoized
+
+    Decimal literals go through int() directly, since Python rejects ones
+    with leading zeros; everything else is read as a Python literal.
+    """
+    if string not in literal_memo:
+        if all(c.isnumeric() for c in string):
+            literal_memo[string] = int(string)
+        else:
+            literal_memo[string] = ast.literal_eval(string)
+    return literal_memo[string]
 
 def find_nodes(tree, label):
-    """Filters the tree to only nodes labeled @label"""
-    if not isinstance(tree, list):
-        return []
-    if tree[0] == label:
-        return [tree]
-    result = []
-    for child in tree:
-        result.extend(find_nodes(child, label))
+    """Filters the tree to only nodes labeled @label
+
+    Walks the tree with an explicit stack, pushing children in reverse so
+    nodes come out in the same left-to-right order as a recursive walk.
+    """
+    result, stack = [], [tree]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, (list, tuple)) or not node: continue
+        if node[0] == label:
+            result.append(node)
+        else:
+            stack.extend(reversed(node))
     return result
 
+cases_peg = PEG()
+cases_peg.rule("Case", "(/ (str case) (str default)) (skipto (str :))")
+cases_peg.rule("CaseOrSkip", "(/ (: Case) (balanced) (balanced { }) (.)) (? (: CaseOrSkip))")
 def find_cases(lexemes):
     """Parses the body of a switch for case statements"""
-    peg = PEG()
-    peg.rule("Case", "(/ (str case) (str default)) (skipto (str :))")
-    peg.rule("CaseOrSkip", "(/ (: Case) (balanced) (balanced { }) (.)) (? (: CaseOrSkip))")
-    matches, remainder = peg.parse("(: CaseOrSkip)", lexemes)
+    matches, remainder = cases_peg.parse("(: CaseOrSkip)", lexemes)
     assert not remainder
     cases = find_nodes(matches, "Case")
     cleaned = []
@@ -163,6 +234,13 @@ def find_cases(lexemes):
             cleaned.append(([], tree))
     return cleaned
 
+# Statement types (see parse_some_cf) whose first lexeme is always the same.
+stmt_keywords = dict({
+    "IfStmt": "if", "DoWhile": "do", "While": "while", "For": "for",
+    "Switch": "switch", "Goto": "goto", "GotoITE": "goto_ite",
+    "Break": "break", "Continue": "continue", "Return": "return",
+    "Block": "{", "EndBlock": "}",
+})
 def find_stmts(lexemes, stmt_types, skip_types):
     """Recursively parses @lexemes and returns those of type @stmt_types
 
@@ -173,44 +251,72 @@ def find_stmts(lexemes, stmt_types, skip_types):
     use @skip_types to tell it not to recurse into sub-while statements,
     because their "break"s should goto a different location.
     """
+    # If every type of interest starts with a fixed keyword, no other position
+    # can parse as one of them, so skip straight to the next keyword.
+    types = tuple(stmt_types) + tuple(skip_types)
+    keywords = None
+    if all(t in stmt_keywords for t in types):
+        keywords = set(stmt_keywords[t] for t in types)
     results = []
-    while lexemes:
-        tree, _ = parse_some_cf(lexemes)
+    pos = 0
+    while pos < len(lexemes):
+        if keywords is not None and lexemes[pos].string not in keywords:
+            pos = next((i for i in range(pos, len(lexemes))
+                        if lexemes[i].string in keywords), len(lexemes))
+            continue
+        tree, end = parse_some_cf_at(lexemes, pos)
         if tree:
             assert tree[0] == "Statement"
             if tree[1][0] in stmt_types:
                 results.append(tree)
             if tree[1][0] in skip_types:
-                lexemes = lexemes[lexemes.index(relex(tree)[-1]):]
-        lexemes = lexemes[1:]
+                # Every lexeme the statement consumed is in its tree, so its
+                # last one is just before @end.
+                pos = end - 1
+        pos += 1
     return results
 
 find_fn_memo = dict()
-def find_fn(name_lex):
-    """Find a function declaration with the given name"""
+def find_fn(name_lex, fn_tree=None):
+    """Find a function declaration with the given name
+
+    If the caller already has the Function parse tree for @name_lex (e.g.,
+    while stepping over the definition itself), passing it as @fn_tree avoids
+    searching the file for it.
+    """
     key = (name_lex.lexing, name_lex.string)
     if key in find_fn_memo:
         return find_fn_memo[key]
-    depth = 0
-    name_lexemes = []
-    for l in name_lex.lexing.lexemes:
-        if depth == 0 and l.string == name_lex.string:
-            name_lexemes.append(l)
-        depth += (l.string == "{")
-        depth -= (l.string == "}")
-    for lexeme in name_lexemes:
-        suffix = lexeme.lexing.lexemes[lexeme.lexing.lexemes.index(lexeme):]
-        tree, _ = parse_some_cf(suffix)
-        if tree is not False and tree[1][0] == "Function":
-            params = next(c for c in tree[1] if c[0] == "bal" and relex(c)[0].string == "(")
-            params = [x[-1].string for x in parse_csv(relex(params)[1:-1]) if x]
-            body = next(c for c in tree[1] if c[0] == "bal" and relex(c)[0].string == "{")
-            first_lex = relex(body)[0]
-            find_fn_memo[key] = first_lex, params
-            return first_lex, params
+    if fn_tree is not None:
+        find_fn_memo[key] = fn_signature(fn_tree)
+        return find_fn_memo[key]
+    # Visit only the lexemes spelling the name, via the lexing's string index.
+    # Parsing one is usually cheaper than finding its brace depth, so the
+    # depth is only advanced (incrementally) for those that parse as Functions.
+    lexing = name_lex.lexing
+    depth, scanned = 0, 0
+    for lexeme in lexing.occurrences(name_lex.string):
+        i = lexing.index(lexeme)
+        tree, _ = parse_some_cf(lexing.lexemes[i:])
+        if tree is False or tree[1][0] != "Function":
+            continue
+        for l in lexing.lexemes[scanned:i]:
+            depth += (l.string == "{")
+            depth -= (l.string == "}")
+        scanned = i
+        if depth == 0:
+            find_fn_memo[key] = fn_signature(tree[1])
+            return find_fn_memo[key]
     find_fn_memo[key] = False, False
     return False, False
 
+def fn_signature(fn_tree):
+    """First lexeme of the body and parameter names of a Function tree"""
+    params = next(c for c in fn_tree if c[0] == "bal" and relex(c)[0].string == "(")
+    params = [x[-1].string for x in parse_csv(relex(params)[1:-1]) if x]
+    body = next(c for c in fn_tree if c[0] == "bal" and relex(c)[0].string == "{")
+    return relex(body)[0], params
+
 def parse_macro(string):
     """Parse a C macro given its string representation"""
     from framework.lex import lex_c
@@ -239,4 +345,43 @@ def parse_macro(string):
             macro["pattern"].append(args.index(lexeme.string))
         else:
             macro["pattern"].append(lexeme.string)
+    macro["expand"] = macro_expander(macro["pattern"])
     return macro
+
+def macro_expander(pattern):
+    """Precompiles a function-like macro's pattern into an expander
+
+    The expander maps a list of argument lexeme lists to a Lexing.rewrite
+    pattern, where {i} refers to the ith argument. Everything that does not
+    depend on the arguments is formatted once, here, rather than once per
+    expansion site.
+    """
+    pieces = []
+    for x in pattern:
+        if isinstance(x, str):
+            static = " " + x.replace("{", "{{").replace("}", "}}")
+        elif isinstance(x, int):
+            static = " " + f"{{{x}}}"
+        elif x[0] == "pasteify-str":
+            static = x[1]
+        elif x[0] in ("strify", "pasteify"):
+            pieces.append(x)
+            continue
+        else:
+            raise NotImplementedError
+        if pieces and isinstance(pieces[-1], str):
+            pieces[-1] += static
+        else:
+            pieces.append(static)
+    def expand(args):
+        """Builds the rewrite pattern for one expansion"""
+        pattern = ""
+        for piece in pieces:
+            if isinstance(piece, str):
+                pattern += piece
+            elif piece[0] == "strify":
+                pattern += " " + "\"" + " ".join([l.string for l in args[piece[1]]]) + "\""
+            else:
+                pattern += " ".join([l.string for l in args[piece[1]]])
+        return pattern
+    return expand
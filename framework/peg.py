@@ -1,9 +1,20 @@
 """A simple PEG parser library.
 
 Grammars are specified in an S-expression syntax. Inputs to be parsed are
-represented as lists of Lexemes (see lex.py). Resulting trees ar elists of the
-form ["label", child1, child2, ...].
+represented as lists of Lexemes (see lex.py). Resulting trees are tuples of the
+form ("label", child1, child2, ...), though the runs of lexemes matched by
+skipto and balanced are plain lists.
 """
+import re
+import sys
+
+# Opcodes for compiled parsing expressions; see PEG.compile_.
+OP_STR, OP_LABEL, OP_ANY, OP_OPT, OP_ALT, OP_SEQ, OP_CALL, OP_AND, OP_NOT, \
+    OP_SKIPTO, OP_BAL, OP_SKIPTO_LITS = range(12)
+
+# What every parse handler returns when the input doesn't match
+FAIL = (None, -1)
+
 class PEG:
     """Represents a parsing expression grammar
 
@@ -15,139 +26,410 @@ class PEG:
     def __init__(self):
         """Create a blank PEG"""
         self.rules = dict()
+        # Rules are called by integer id; a rule may be referenced (and so
+        # given an id) before it is defined.
+        self.rule_ids_ = dict()
+        self.rule_names_ = []
+        self.rule_bodies_ = []
+        # Compiled top-level expressions passed to parse, keyed by the string
+        # or by id() of the (expr, code) list.
+        self.compiled_ = dict()
+        # Packrat memo for the current top-level parse: maps (rule id,
+        # position) -> (node, position after the match).
+        self.memo_ = dict()
+        # Also per top-level parse: maps parens -> {open index: match index},
+        # filled in by find_balance.
+        self.balance_memo_ = dict()
+        # Maps id(code) -> (code, FIRST set), see first_. Alternations also
+        # cache which branches can start at each (string, label), see
+        # parse_alt_; both depend on the rules, so rule resets them.
+        self.firsts_ = dict()
+        self.alt_caches_ = []
 
     def rule(self, name, expr):
         """Add a labeled rule to the PEG"""
-        expr = parse_expr_str("(" + expr + ")")
+        if expr not in RULE_EXPR_MEMO:
+            RULE_EXPR_MEMO[expr] = parse_expr_str("(" + expr + ")")
+        expr = RULE_EXPR_MEMO[expr]
         self.rules[name] = expr
+        # Compiled lazily, see rule_body_
+        self.rule_bodies_[self.rule_id_(name)] = None
+        self.firsts_.clear()
+        for cache in self.alt_caches_:
+            cache.clear()
 
-    def parse(self, expr, lexemes):
-        """Recursive descent PEG parsing"""
-        # Some preprocessing...
+    def rule_id_(self, name):
+        """Integer id of the rule labeled @name, allocating one if needed"""
+        if name not in self.rule_ids_:
+            self.rule_ids_[name] = len(self.rule_names_)
+            self.rule_names_.append(name)
+            self.rule_bodies_.append(None)
+        return self.rule_ids_[name]
+
+    def rule_body_(self, rule_id):
+        """Compiled body of rule @rule_id (a tuple of sequenced children)"""
+        if self.rule_bodies_[rule_id] is None:
+            name = self.rule_names_[rule_id]
+            self.rule_bodies_[rule_id] = tuple(map(self.compile_,
+                                                   self.rules[name]))
+        return self.rule_bodies_[rule_id]
+
+    def compile_(self, expr):
+        """Compile the S-expression @expr to an (opcode, payload, children)
+        tuple, where children are themselves compiled"""
         if isinstance(expr, str):
             expr = parse_expr_str(expr)
-        if expr[0] == "strany":
-            expr = ["/"] + list(map(lambda x: ["str", x], expr[1:]))
-        # Then actual parsing rules
-        if expr[0] == "str":    # string literal
-            if lexemes and lexemes[0].string == expr[1]:
-                return lexemes[0], lexemes[1:]
-            return False, False
-        if expr[0] == "::":     # lexeme labeled
-            if lexemes and lexemes[0].label == expr[1]:
-                return lexemes[0], lexemes[1:]
-            return False, False
-        if expr[0] == ".":      # any token
-            if lexemes:
-                return lexemes[0], lexemes[1:]
-            return False, False
-        if expr[0] in "?":      # optional match
-            node = ["?"]
-            remainder = lexemes
-            for sub in expr[1:]:
-                child, remainder = self.parse(sub, remainder)
-                if child is False: return None, lexemes
-                if child: node.append(child)
-            return node, remainder
-        if expr[0] == "/":      # any of these
-            for sub in expr[1:]:
-                node, remainder = self.parse(sub, lexemes)
-                if node is not False:
-                    return node, remainder
-            return False, False
-        if expr[0] == "seq":    # sequence of tokens
-            node = ["seq"]
-            for sub in expr[1:]:
-                child, lexemes = self.parse(sub, lexemes)
-                if child is False:
-                    return False, False
-                if child: node.append(child)
-            assert lexemes is not False
-            return node, lexemes
-        if expr[0] == ":":      # recurse into non-terminal
-            node = [expr[1]]
-            for sub in self.rules[expr[1]]:
-                child, lexemes = self.parse(sub, lexemes)
-                if child is False:
-                    return False, False
-                if child: node.append(child)
-            assert lexemes is not False
-            return node, lexemes
-        if expr[0] in ("&", "!"): # positive, negative lookaheads
-            node, _ = self.parse(["seq", expr[1]], lexemes)
-            if (not node) is (expr[0] == "!"):
-                return None, lexemes
-            return False, False
-        # The next two are less common as PEG primitives. The first is skipto,
-        # modified from Brown, N\"otzli, Engler '16. (skipto foo) will skip
-        # over tokens lazily until it finds something matching the expression
-        # foo. Ours will skip over balanced parentheses as a group:
-        # (skipto (str foo)) on "(foo) foo" will skip the entire "(foo)".
-        if expr[0] == "skipto": # balanced skipto
+        head = expr[0]
+        # Lexeme strings and labels are interned, so interning the payloads
+        # lets the handlers match them by identity.
+        if head == "strany":
+            return self.compile_alt_(
+                tuple((OP_STR, sys.intern(x), ()) for x in expr[1:]))
+        if head == "str": return (OP_STR, sys.intern(expr[1]), ())
+        if head == "::": return (OP_LABEL, sys.intern(expr[1]), ())
+        if head == ".": return (OP_ANY, None, ())
+        if head in "?":
+            return (OP_OPT, None, tuple(map(self.compile_, expr[1:])))
+        if head == "/":
+            return self.compile_alt_(tuple(map(self.compile_, expr[1:])))
+        if head == "seq":
+            return (OP_SEQ, None, tuple(map(self.compile_, expr[1:])))
+        if head == ":": return (OP_CALL, self.rule_id_(expr[1]), ())
+        if head in ("&", "!"):
+            op = OP_AND if head == "&" else OP_NOT
+            return (op, None, (self.compile_(["seq", expr[1]]),))
+        if head == "skipto":
             if len(expr) > 2:
                 expr = ["skipto", ["seq", *expr[1:]]]
-            i = 0
-            while i <= len(lexemes):
-                skipped_to, remainder = self.parse(expr[1], lexemes[i:])
-                if skipped_to is not False:
-                    result = ["skipto", lexemes[0:i], skipped_to or []]
-                    return result, remainder
-                close_i = find_balance(lexemes[i:], "()")
-                if close_i is False: close_i = find_balance(lexemes[i:], "{}")
-                if close_i is False: close_i = find_balance(lexemes[i:], "[]")
-
-                if close_i is False:
-                    i += 1
-                else:
-                    i += close_i + 1
-            return False, False
-        # The second simply matches a pair of balanced parens, by default round
-        # parens but you can instruct it to use others.
-        if expr[0] == "balanced": # match balanced parens
+            target = self.compile_(expr[1])
+            # Skipping to one of a set of literals is common enough (e.g., to
+            # the next ;) to get its own loop, which never recurses.
+            if target[0] == OP_STR:
+                return (OP_SKIPTO_LITS, frozenset([target[1]]), ())
+            if target[0] == OP_ALT and all(c[0] == OP_STR for c in target[2]):
+                return (OP_SKIPTO_LITS,
+                        frozenset(c[1] for c in target[2]), ())
+            return (OP_SKIPTO, None, (target,))
+        if head == "balanced":
             parens = expr[1:] or ["(", ")"]
             if len(expr) == 2 and expr[1] == "rev":
                 parens = [")", "("]
-            close_i = find_balance(lexemes, parens)
-            if close_i is False:
-                return False, False
-            result = ["bal", lexemes[0], lexemes[1:close_i], lexemes[close_i]]
-            return result, lexemes[(close_i + 1):]
+            return (OP_BAL, tuple(map(sys.intern, parens)), ())
         print(expr)
         raise NotImplementedError
 
+    def compile_alt_(self, children):
+        """Compile an alternation of the compiled @children"""
+        cache = dict()
+        self.alt_caches_.append(cache)
+        return (OP_ALT, cache, children)
+
+    def first_(self, code, visiting=()):
+        """FIRST set of the compiled expression @code
+
+        Either None, if @code might match without consuming a lexeme (or we
+        can't tell cheaply), or a set of ("str", string) and ("::", label)
+        entries, one of which the first lexeme of every match satisfies.
+        """
+        if id(code) in self.firsts_:
+            return self.firsts_[id(code)][1]
+        op, payload, children = code
+        first = None
+        if op == OP_STR: first = {("str", payload)}
+        elif op == OP_LABEL: first = {("::", payload)}
+        elif op == OP_BAL: first = {("str", payload[0])}
+        elif op == OP_ALT:
+            first = set()
+            for child in children:
+                child_first = self.first_(child, visiting)
+                if child_first is None:
+                    first = None
+                    break
+                first |= child_first
+        elif op == OP_SEQ and children:
+            first = self.first_(children[0], visiting)
+        elif op == OP_CALL and payload not in visiting:
+            body = self.rule_body_(payload)
+            if body:
+                first = self.first_(body[0], visiting + (payload,))
+        # Results found while a rule was being visited may have been cut off
+        # by the recursion check, so only cache outermost ones.
+        if not visiting:
+            self.firsts_[id(code)] = (code, first)
+        return first
+
+    def skipto_strings(self, name):
+        """Strings one of which rule @name must skipto from its start
+
+        If the rule begins (after any lookaheads) with a skipto whose target
+        always starts with one of a set of literal strings, returns that set;
+        the rule can only match lexemes where skipto_visits includes one of
+        them. Otherwise returns None.
+        """
+        for op, payload, children in self.rule_body_(self.rule_id_(name)):
+            if op in (OP_AND, OP_NOT):
+                continue
+            if op == OP_SKIPTO_LITS:
+                return payload
+            if op == OP_SKIPTO:
+                first = self.first_(children[0])
+                if first and all(kind == "str" for kind, _ in first):
+                    return frozenset(string for _, string in first)
+            return None
+        return None
+
+    def parse(self, expr, lexemes):
+        """Parse @lexemes against @expr, returning (tree, remaining_lexemes)"""
+        node, pos = self.parse_from(expr, lexemes, 0)
+        if node is False:
+            return False, False
+        return node, lexemes[pos:]
+
+    def parse_from(self, expr, lexemes, pos):
+        """Parse @lexemes[@pos:] against @expr without slicing @lexemes
+
+        Returns (tree, index just past the match), or (False, @pos).
+        """
+        key = expr if isinstance(expr, str) else id(expr)
+        if key not in self.compiled_ or self.compiled_[key][0] is not expr:
+            self.compiled_[key] = (expr, self.compile_(expr))
+        try:
+            node, end = self.parse_at(self.compiled_[key][1], lexemes, pos)
+        finally:
+            self.memo_.clear()
+            self.balance_memo_.clear()
+        if end < 0:
+            return False, pos
+        return node, end
+
+    def parse_at(self, code, lexemes, pos):
+        """Recursive descent PEG parsing of @lexemes starting at index @pos
+
+        @code is a compiled expression (see compile_). Returns (node, new_pos),
+        where new_pos is negative if there was no match (see FAIL) and node is
+        () if the match has no tree.
+        """
+        op, payload, children = code
+        return PEG.HANDLERS[op](self, payload, children, lexemes, pos)
+
+    def parse_str_(self, string, _, lexemes, pos):
+        """String literal"""
+        if pos < len(lexemes) and lexemes[pos].string is string:
+            return lexemes[pos], pos + 1
+        return FAIL
+
+    def parse_label_(self, label, _, lexemes, pos):
+        """Lexeme labeled @label"""
+        if pos < len(lexemes) and lexemes[pos].label is label:
+            return lexemes[pos], pos + 1
+        return FAIL
+
+    def parse_any_(self, _, __, lexemes, pos):
+        """Any token"""
+        if pos < len(lexemes):
+            return lexemes[pos], pos + 1
+        return FAIL
+
+    def parse_opt_(self, _, children, lexemes, pos):
+        """Optional match"""
+        node = ["?"]
+        end = pos
+        for op, payload, kids in children:
+            child, end = PEG.HANDLERS[op](self, payload, kids, lexemes, end)
+            if end < 0: return (), pos
+            if child: node.append(child)
+        return tuple(node), end
+
+    def parse_alt_(self, cache, children, lexemes, pos):
+        """Any of these
+
+        Only tries the branches whose FIRST set admits lexemes[pos]; @cache
+        maps the lexeme's (string, label) to those branches.
+        """
+        key = None
+        if pos < len(lexemes):
+            key = (lexemes[pos].string, lexemes[pos].label)
+        if key not in cache:
+            cache[key] = tuple(child for child in children
+                               if self.may_start_(child, key))
+        for op, payload, kids in cache[key]:
+            node, end = PEG.HANDLERS[op](self, payload, kids, lexemes, pos)
+            if end >= 0:
+                return node, end
+        return FAIL
+
+    def may_start_(self, code, key):
+        """False only if @code cannot match starting at a lexeme with the
+        (string, label) @key, or at the end of input if @key is None"""
+        first = self.first_(code)
+        if first is None:
+            return True
+        return key is not None and (("str", key[0]) in first
+                                    or ("::", key[1]) in first)
+
+    def parse_seq_(self, _, children, lexemes, pos):
+        """Sequence of tokens"""
+        return self.parse_body_("seq", children, lexemes, pos)
+
+    def parse_call_(self, rule_id, _, lexemes, pos):
+        """Recurse into non-terminal"""
+        key = (rule_id, pos)
+        if key not in self.memo_:
+            self.memo_[key] = self.parse_body_(self.rule_names_[rule_id],
+                                               self.rule_body_(rule_id),
+                                               lexemes, pos)
+        return self.memo_[key]
+
+    def parse_and_(self, _, children, lexemes, pos):
+        """Positive lookahead"""
+        _, end = self.parse_at(children[0], lexemes, pos)
+        if end >= 0:
+            return (), pos
+        return FAIL
+
+    def parse_not_(self, _, children, lexemes, pos):
+        """Negative lookahead"""
+        _, end = self.parse_at(children[0], lexemes, pos)
+        if end < 0:
+            return (), pos
+        return FAIL
+
+    # The next two are less common as PEG primitives. The first is skipto,
+    # modified from Brown, N\"otzli, Engler '16. (skipto foo) will skip
+    # over tokens lazily until it finds something matching the expression
+    # foo. Ours will skip over balanced parentheses as a group:
+    # (skipto (str foo)) on "(foo) foo" will skip the entire "(foo)".
+    def parse_skipto_(self, _, children, lexemes, pos):
+        """Balanced skipto"""
+        i = pos
+        while i <= len(lexemes):
+            skipped_to, end = self.parse_at(children[0], lexemes, i)
+            if end >= 0:
+                result = ("skipto", lexemes[pos:i], skipped_to or [])
+                return result, end
+            if i < len(lexemes) and lexemes[i].string in SKIPTO_PARENS:
+                i = skip_group(lexemes, i, self.balance_memo_)
+            else:
+                i += 1
+        return FAIL
+
+    def parse_skipto_lits_(self, strings, _, lexemes, pos):
+        """Balanced skipto the first lexeme whose string is in @strings"""
+        i = pos
+        while i < len(lexemes):
+            string = lexemes[i].string
+            if string in strings:
+                return ("skipto", lexemes[pos:i], lexemes[i]), i + 1
+            if string in SKIPTO_PARENS:
+                i = skip_group(lexemes, i, self.balance_memo_)
+            else:
+                i += 1
+        return FAIL
+
+    # The second simply matches a pair of balanced parens, by default round
+    # parens but you can instruct it to use others.
+    def parse_bal_(self, parens, _, lexemes, pos):
+        """Match balanced parens"""
+        close_i = find_balance(lexemes, parens, pos,
+                               self.balance_memo_.setdefault(parens, dict()))
+        if close_i is False:
+            return FAIL
+        result = ("bal", lexemes[pos], lexemes[(pos + 1):close_i],
+                  lexemes[close_i])
+        return result, close_i + 1
+
+    def parse_body_(self, label, children, lexemes, pos):
+        """Match @children in sequence into a node labeled @label"""
+        node = [label]
+        for op, payload, kids in children:
+            child, pos = PEG.HANDLERS[op](self, payload, kids, lexemes, pos)
+            if pos < 0:
+                return FAIL
+            if child: node.append(child)
+        return tuple(node), pos
+
+    # Indexed by opcode
+    HANDLERS = (parse_str_, parse_label_, parse_any_, parse_opt_, parse_alt_,
+                parse_seq_, parse_call_, parse_and_, parse_not_, parse_skipto_,
+                parse_bal_, parse_skipto_lits_)
+
 from framework.lex import Lexeme
 def filterlex(tree):
     """Given a tree, forms a new tree where node labels are removed.
 
-    E.g., ["label", child1, child2, ...] becomes just [child1, child2, ...]
+    E.g., ("label", child1, child2, ...) becomes just [child1, child2, ...]
     """
     newtree = []
     for obj in tree:
-        if isinstance(obj, list):
+        if isinstance(obj, (list, tuple)):
             newtree.append(filterlex(obj))
         elif isinstance(obj, Lexeme):
             newtree.append([obj])
     return list(filter(None, newtree))
 
+# Maps id(tree) -> (tree, tuple of its lexemes), for trees whose lexemes a
+# caller already knows and which it keeps alive, so their ids stay unique
+# (see parse_some_expr).
+RELEX_MEMO = dict()
 def relex(tree):
     """Helper to flatten a tree to a list of its lexemes"""
-    if isinstance(tree, Lexeme):
-        return [tree]
-    if isinstance(tree, list):
-        flattened = []
-        for child in tree:
-            flattened.extend(relex(child))
-        return flattened
-    return []
+    cached = RELEX_MEMO.get(id(tree))
+    if cached is not None and cached[0] is tree:
+        return list(cached[1])
+    # Iterative, so there's one output list rather than one per node.
+    flattened = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Lexeme):
+            flattened.append(node)
+        elif isinstance(node, (list, tuple)):
+            stack.extend(node[::-1])
+    return flattened
 
 EXPR_STR_MEMO = dict()
-def parse_expr_str(string, need_copy=False):
-    """Memoized S-expr parser"""
-    if need_copy: return parse_expr_str_(string, need_copy)
+# Maps rule string -> parse_expr_str of it wrapped in parens, so PEG.rule
+# doesn't build the wrapped string just to look it up
+RULE_EXPR_MEMO = dict()
+def parse_expr_str(string):
+    """Memoized S-expr parser
+
+    The result is shared between callers, so it must not be mutated.
+    """
     if string not in EXPR_STR_MEMO:
-        EXPR_STR_MEMO[string] = parse_expr_str_(string, need_copy)
+        EXPR_STR_MEMO[string] = parse_expr_str_(string)
     return EXPR_STR_MEMO[string]
-def parse_expr_str_(string, need_copy):
+EXPR_TEMPLATE_MEMO = dict()
+def parse_expr_template(string):
+    """Memoized parser for IR patterns with holes, as used by Interpreter.emit
+
+    Like parse_expr_str, except every hole below the root is compiled to a
+    tuple: ("e", i) for e{i} and ("arg", i) for {i}. Sublists without any
+    holes are wrapped as ("const", sublist) so filling can share them as-is.
+    """
+    if string not in EXPR_TEMPLATE_MEMO:
+        def compile_(n):
+            if isinstance(n, list):
+                children = [compile_(child) for child in n]
+                if all(isinstance(c, str)
+                       or (isinstance(c, tuple) and c[0] == "const")
+                       for c in children):
+                    return ("const", n)
+                return children
+            if n[0] == "e" and n[1] == "{" and n[-1] == "}":
+                return ("e", int(n[2:-1]))
+            if n[0] == "{" and n[-1] == "}":
+                return ("arg", int(n[1:-1]))
+            return n
+        expr = parse_expr_str(string)
+        if isinstance(expr, list):
+            expr = [compile_(child) for child in expr]
+        EXPR_TEMPLATE_MEMO[string] = expr
+    return EXPR_TEMPLATE_MEMO[string]
+# The characters parse_expr_str_ cares about, and whitespace to skip
+SEXPR_SPECIAL = re.compile(r"[() \n]")
+SEXPR_SPACE = re.compile(r"\s*")
+def parse_expr_str_(string):
     """S-expr parser "(a (b c) d)" -> ["a", ["b", "c"], "d"]
 
     Note this is pretty simple, and doesn't handle escapes, string literals,
@@ -160,30 +442,79 @@ def parse_expr_str_(string, need_copy):
     if not (string[0] == '(' and string[-1] == ')'):
         return string
     string = string[1:-1]
+    # Each argument runs up to the first space or newline outside of parens;
+    # the whitespace after it (and at the end) is skipped. Rather than
+    # stepping through every character, jump between the special ones.
     expr = []
-    while string:
-        arg_str = string
-        depth = 0
-        for i, c in enumerate(string):
-            if c == '(': depth += 1
-            if c == ')': depth -= 1
-            if c in (' ', '\n') and depth == 0:
-                arg_str = string[:i]
-                break
-        expr.append(parse_expr_str(arg_str, need_copy))
-        string = string[len(arg_str):].strip()
+    start, depth, end = 0, 0, len(string)
+    for match in SEXPR_SPECIAL.finditer(string):
+        if match.start() >= end:
+            break
+        if match.start() < start:
+            continue
+        c = match.group()
+        if c == '(': depth += 1
+        elif c == ')': depth -= 1
+        elif depth == 0:
+            expr.append(parse_expr_str(string[start:match.start()]))
+            start = SEXPR_SPACE.match(string, match.end()).end()
+            end = len(string.rstrip())
+    if start < end:
+        expr.append(parse_expr_str(string[start:end]))
     return expr
 
-def find_balance(lexemes, parens):
-    """Finds a matching parenthesis in a list of lexemes"""
-    if not lexemes or lexemes[0].string != parens[0]:
+# Parens skipto steps over as a group, keyed by the opening paren
+SKIPTO_PARENS = dict({"(": ("(", ")"), "{": ("{", "}"), "[": ("[", "]")})
+
+def skipto_visits(lexemes):
+    """Set of the strings of every lexeme a skipto from the start of @lexemes
+    stops to check, i.e., those not nested in a balanced group"""
+    visited = set()
+    i = 0
+    while i < len(lexemes):
+        string = lexemes[i].string
+        visited.add(string)
+        if string in SKIPTO_PARENS:
+            i = skip_group(lexemes, i)
+        else:
+            i += 1
+    return visited
+
+def skip_group(lexemes, i, tables=None):
+    """Where skipto goes after the opening paren at @lexemes[@i]: just past
+    its match, or just past it if it is never closed
+
+    @tables optionally maps parens -> find_balance table to use.
+    """
+    parens = SKIPTO_PARENS[lexemes[i].string]
+    table = None if tables is None else tables.setdefault(parens, dict())
+    close_i = find_balance(lexemes, parens, i, table)
+    if close_i is False:
+        return i + 1
+    return close_i + 1
+
+def find_balance(lexemes, parens, pos=0, table=None):
+    """Finds the index of the match for the parenthesis at @lexemes[@pos]
+
+    If @table is given it caches {open index: match index or False} for
+    @lexemes; every paren nested inside the one at @pos is recorded too, so
+    later searches from inside that span are lookups.
+    """
+    if table is not None and pos in table:
+        return table[pos]
+    if pos >= len(lexemes) or lexemes[pos].string != parens[0]:
         return False
-    depth = 1
-    for i in range(1, len(lexemes)):
-        if lexemes[i].string == parens[1]:
-            depth -= 1
-        if lexemes[i].string == parens[0]:
-            depth += 1
-        if depth == 0:
-            return i
+    if table is None:
+        table = dict()
+    opens = [pos]
+    for i in range(pos + 1, len(lexemes)):
+        string = lexemes[i].string
+        if string == parens[1]:
+            table[opens.pop()] = i
+            if not opens:
+                return i
+        elif string == parens[0]:
+            opens.append(i)
+    for open_i in opens:
+        table[open_i] = False
     return False
@@ -0,0 +1,103 @@
+"""The REPL shared by the SSIs
+
+Commands either take no arguments (COMMANDS) or are followed by a space and
+their arguments (ARG_COMMANDS). Handlers are called as handler(interpreter,
+args); a handler returning True leaves the REPL. SSIs pass their own
+driver-specific commands (e.g., "probe") to REPL.
+
+When the REPL reads from a terminal and readline is available, input gets
+line editing, tab completion of command names, and a history saved in
+HISTORY_FILE.
+"""
+import atexit
+import os
+import sys
+try:
+    import readline
+except ImportError:
+    readline = None
+
+HISTORY_FILE = os.path.expanduser("~/.ssi_history")
+
+readline_ready_ = False
+def setup_readline_():
+    """Loads the saved history and arranges for it to be written on exit
+
+    Only does anything the first time it is called.
+    """
+    global readline_ready_
+    if readline_ready_:
+        return
+    readline_ready_ = True
+    # macOS ships readline backed by libedit, which has its own bind syntax
+    if "libedit" in (readline.__doc__ or ""):
+        readline.parse_and_bind("bind ^I rl_complete")
+    else:
+        readline.parse_and_bind("tab: complete")
+    try:
+        readline.read_history_file(HISTORY_FILE)
+    except OSError:
+        pass
+    def save_history():
+        try:
+            readline.write_history_file(HISTORY_FILE)
+        except OSError:
+            pass
+    atexit.register(save_history)
+
+def cmd_pm(interpreter, args):
+    """Prints all of memory"""
+    interpreter.trace.memory.print_pyify()
+
+def cmd_xc(interpreter, args):
+    """Executes a C expression and prints the result"""
+    result = interpreter.exec_c(args)
+    if result:
+        result.as_memref().print_pyify()
+
+def cmd_verbose(interpreter, args):
+    """verbose fn fmt1 fmt2 ... prints fn's arguments whenever it's called"""
+    fn_name = args.split(" ")[0]
+    formatters = args.split(" ")[1:]
+    interpreter.verbose_fns[fn_name] = formatters
+
+def cmd_continue(interpreter, args):
+    """Leaves the REPL"""
+    return True
+
+COMMANDS = dict({"pm": cmd_pm, "c": cmd_continue})
+ARG_COMMANDS = dict({"xc": cmd_xc, "verbose": cmd_verbose})
+
+def REPL(interpreter, commands=None, arg_commands=None):
+    """Reads and runs commands until one leaves the REPL
+
+    @commands and @arg_commands are added to COMMANDS and ARG_COMMANDS. The
+    "b line" command sets a breakpoint that enters this same REPL again.
+    """
+    all_commands = dict(COMMANDS)
+    all_commands.update(commands or dict())
+    all_arg_commands = dict(ARG_COMMANDS)
+    all_arg_commands.update(arg_commands or dict())
+    def cmd_break(interpreter, args):
+        line_number = int(args.split(" ")[0])
+        interpreter.break_lines[line_number] = (
+            lambda interpreter: REPL(interpreter, commands, arg_commands))
+    all_arg_commands.setdefault("b", cmd_break)
+    if readline is not None and sys.stdin.isatty():
+        setup_readline_()
+        names = sorted(set(all_commands) | set(all_arg_commands))
+        def complete(text, state):
+            matches = [name for name in names if name.startswith(text)]
+            return matches[state] if state < len(matches) else None
+        readline.set_completer(complete)
+
+    if interpreter.curr_lexeme:
+        print("ssi :: On line", interpreter.curr_lexeme.line_number)
+    while True:
+        command = input("ssi > ")
+        name, space, args = command.partition(" ")
+        handler = (all_arg_commands if space else all_commands).get(name)
+        if handler is None:
+            print(f"ssi > Unknown command '{command}'")
+        elif handler(interpreter, args):
+            break
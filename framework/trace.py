@@ -21,11 +21,46 @@ The basic organization is as follows:
       allocated for it to point to. This is essentially like calling
       malloc(infinity) every time you dealloc a fresh pointer.
 """
-import copy
+import bisect
+import operator
 import framework.lex as lex
 
+# Python implementations of the binary and unary IR operators, with C's /
+# already mapped to //.
+BINOPS = dict({
+    "+": operator.add, "-": operator.sub, "*": operator.mul,
+    "//": operator.floordiv, "%": operator.mod,
+    "<<": operator.lshift, ">>": operator.rshift,
+    "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge,
+    "==": operator.eq, "!=": operator.ne,
+    "&": operator.and_, "^": operator.xor, "|": operator.or_,
+})
+UNOPS = dict({"-": operator.neg, "~": operator.invert})
+
+# Maps binary emit_ op names (e.g., "bin_/") -> their functions, see binop
+BINOP_MEMO = dict()
+
+def binop(op):
+    """Gets the function for a binary emit_ op @op, or None if not binary"""
+    if op in BINOP_MEMO:
+        return BINOP_MEMO[op]
+    fn = None
+    if op in ("+", "==", "!=", "<") or op.startswith("bin_"):
+        name = op[len("bin_"):] if op.startswith("bin_") else op
+        if name == "/": name = "//"
+        fn = BINOPS.get(name)
+        if fn is None:
+            # Not valid Python operators (e.g., &&); this fails the same way
+            # it always has once the operands are concrete.
+            fn = lambda x, y: eval(f"x {name} y")
+    BINOP_MEMO[op] = fn
+    return fn
+
 class Value:
     """Represents an equivalence class of values"""
+    __slots__ = ("trace", "value", "concrete", "explanation", "parent_",
+                 "recursive_mem", "memref_", "opaque_")
+
     def __init__(self, value, concrete, trace):
         """Create a new Value
 
@@ -39,36 +74,55 @@ class Value:
         pass the expression list to @value and set @concrete to True.
 
         Every equivalence class has a canonical element (the "most concrete"
-        version). This implementation is pretty shoddy; we essentially assume
-        each equivalence class has at most two elements. This should be
-        improved before moving to more extensive symbolic execution/path
-        scheduling.
+        version). Classes are kept as a union-find forest over parent_; the
+        canonical element is the root, see find().
         """
         self.trace = trace
         self.value = value
         self.concrete = concrete
         self.explanation = trace.val_explanation
-        self.canonical = self
+        self.parent_ = self
         self.recursive_mem = False
+        self.memref_ = None
+        # Whether this is a 'raw' opaque value, so checks don't need to look
+        # inside the payload
+        self.opaque_ = (not concrete and isinstance(value, list)
+                        and value[0] == "opaque")
         assert not (isinstance(self.value, list) and self.concrete
                     and self.value[0] == "opaque")
 
     def get_value(self, n_deref=1):
-        if n_deref == 0:
-            return self.cval()
-        return self.cval().get_value().get_value(n_deref - 1)
+        value = self
+        for _ in range(n_deref):
+            value = value.cval().get_value()
+        return value.cval()
+
+    def find(self):
+        """Returns the canonical element of the equivalence class
+
+        Every Value on the path is pointed directly at the root, so later
+        lookups take a single hop.
+        """
+        root = self
+        while root.parent_ is not root:
+            root = root.parent_
+        node = self
+        while node.parent_ is not root:
+            node.parent_, node = root, node.parent_
+        return root
 
     def cval(self):
         """Returns the value of the canonical element in the equivalence class
         """
-        return self.canonical.value
+        return self.find().value
 
     def explain(self, depth=0):
         """Prints a trace of modifications to this value"""
-        if isinstance(self.canonical.value, list):
+        root = self.find()
+        if isinstance(root.value, list):
             print("|   " * depth + "Value: [opaque expr]")
         else:
-            print("|   " * depth + "Value:", self.canonical.value)
+            print("|   " * depth + "Value:", root.value)
         depth += 1
         print("|   " * depth + "Explanation:",
                 " ".join([l.string for l in self.explanation[0]
@@ -79,7 +133,7 @@ class Value:
 
     def opaque_reason(self):
         """Explains why this value is opaque"""
-        if isinstance(self.cval(), list) and self.cval()[0] == "opaque":
+        if self.find().opaque_:
             return (" ".join([l.string for l in self.explanation[0]
                               if isinstance(l, lex.Lexeme)]) +
                     " on line " + str(self.explanation[0][0].line_number))
@@ -90,37 +144,52 @@ class Value:
 
     def as_memref(self):
         """Explains why this value is opaque"""
-        if self.canonical.concrete:
-            return self.cval()
-        elif self.cval()[0] == "opaque":
-            assert self.canonical == self
-            self.canonical = Value(self.trace.memory.append().child(0),
-                                   True, self.trace)
-            return self.cval()
-        concretized = [arg.as_memref() for arg in self.cval()[1:]]
-        concrete = self.cval()[0](*concretized)
-        assert self.canonical == self
-        self.canonical = Value(concrete, True, self.trace)
-        return self.canonical.value
+        if self.memref_ is not None:
+            return self.memref_
+        root = self.find()
+        if not root.concrete:
+            if root.opaque_:
+                concrete = self.trace.memory.append().child_at(0)
+            else:
+                concretized = [arg.as_memref() for arg in root.value[1:]]
+                concrete = root.value[0](*concretized)
+            root.parent_ = root = Value(concrete, True, self.trace)
+        # A concrete root is never re-parented, so this can't go stale
+        if isinstance(root.value, Memref):
+            self.memref_ = root.value
+        return root.value
 
     def pprint(self):
         """Pretty prints the value"""
-        if self.canonical is not self:
-            return self.canonical.pprint()
+        root = self.find()
+        if root is not self:
+            return root.pprint()
         if isinstance(self.value, Memref):
             print(self.value.address)
         else:
-            print(self.canonical.value)
+            print(self.value)
+
+def memref_key(memref):
+    """Sort key for Memref.children"""
+    return memref.key_
 
 class Memref:
     """Represents a memory cell or range of memory cells in the memory tree"""
+    __slots__ = ("trace", "parent", "address", "key_", "children",
+                 "child_index_", "value")
+
     def __init__(self, parent, address, value, trace=None):
         """Create a new Memref under @parent with the given address and value
         """
         self.trace = trace if trace else parent.trace
         self.parent = parent
         self.address = address
+        # The last address component, i.e., our key in parent.child_index_
+        self.key_ = address[-1] if address else None
+        # Sorted by key_; child_index_ maps each one's last address
+        # component to it, so lookups don't scan the list.
         self.children = []
+        self.child_index_ = dict()
         self.value = value
 
     def get_value(self):
@@ -131,12 +200,22 @@ class Memref:
         """
         if not self.children:
             return self.value
-        summary = Value([self.value]
-                        + [(child.address[-1], child.get_value())
-                           for child in self.children],
-                        True, self.trace)
-        summary.recursive_mem = True
-        return summary
+        # Pre-order list of the ranges below us; building the summaries in
+        # reverse means every child range is summarized before its parent.
+        ranges = [self]
+        for node in ranges:
+            ranges.extend(child for child in node.children if child.children)
+        summaries = dict()
+        for node in reversed(ranges):
+            summary = Value([node.value]
+                            + [(child.key_,
+                                summaries.pop(id(child)) if child.children
+                                else child.value)
+                               for child in node.children],
+                            True, self.trace)
+            summary.recursive_mem = True
+            summaries[id(node)] = summary
+        return summaries[id(self)]
 
     def set_value(self, value):
         """Assign a value to the memory range
@@ -150,7 +229,7 @@ class Memref:
             self.value = value.value[0]
             # TODO: Need to clear existing children?
             for idx, subvalue in value.value[1:]:
-                self.child(idx).set_value(subvalue)
+                self.child_at(idx).set_value(subvalue)
         else:
             self.value = value
 
@@ -160,35 +239,55 @@ class Memref:
         Basically, memory ranges become lists.
         """
         memo = memo or dict()
-        if self.address not in memo:
-            memo[self.address] = []
-            if self.children:
-                for child in self.children:
-                    memo[self.address].append(child.pyify(memo))
+        # Every reachable cell gets its memo entry (a list, or the scalar for
+        # concrete leaves) first, and the lists are filled in afterwards, so
+        # cycles just end up as shared lists.
+        pending = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if id(node) in memo:
+                continue
+            if node.children:
+                targets = node.children
             else:
-                value = self.value.cval()
-                if isinstance(value, Memref):
-                    memo[self.address].append(value.pyify(memo))
-                else:
-                    memo[self.address] = value
-        return memo[self.address]
+                value = node.value.cval()
+                if not isinstance(value, Memref):
+                    memo[id(node)] = value
+                    continue
+                targets = [value]
+            memo[id(node)] = []
+            pending.append((memo[id(node)], targets))
+            stack.extend(targets)
+        for result, targets in pending:
+            result.extend(memo[id(target)] for target in targets)
+        return memo[id(self)]
 
     def print_pyify(self, memo=None, depth=0):
-        """Pretty-prints the memory range"""
+        """Pretty-prints the memory range
+
+        The whole dump is formatted first and written with a single print.
+        """
         memo = memo or set()
-        if self.address in memo:
-            print("|   " * depth + str(self.address))
-        else:
-            memo.add(self.address)
-            if self.children:
-                print("|   " * depth + str(self.address))
-                for child in self.children:
-                    child.print_pyify(memo, depth + 1)
+        lines = []
+        stack = [(self, depth)]
+        while stack:
+            node, depth = stack.pop()
+            if node.address in memo:
+                lines.append("|   " * depth + str(node.address))
+                continue
+            memo.add(node.address)
+            if node.children:
+                lines.append("|   " * depth + str(node.address))
+                stack.extend((child, depth + 1)
+                             for child in reversed(node.children))
             else:
-                value = self.value.cval()
-                print("|   " * depth + str(self.address) + " = " + str(value))
+                value = node.value.cval()
+                lines.append("|   " * depth + str(node.address) + " = "
+                             + str(value))
                 if isinstance(value, Memref):
-                    value.print_pyify(memo, depth + 1)
+                    stack.append((value, depth + 1))
+        print("\n".join(lines))
 
     def field(self, name):
         """Given a Memref representing a struct, gets a Memref for a field
@@ -196,43 +295,44 @@ class Memref:
         Currently, we're just associating each field label with an index and
         treating it as an array lookup.
         """
-        if name not in self.trace.offsets:
-            self.trace.offsets[name] = Value(len(self.trace.offsets),
-                                             True, self)
-        return self.child(self.trace.offsets[name].cval())
+        return self.child_at(self.trace.field_offset(name))
 
     def append(self):
         """Append a new child"""
         if self.children:
             return self.children[-1] + 1
-        return self.child(self.address + (0,))
+        return self.child_at(0)
 
     def child(self, address):
         """Gets a particular child of the node, or insert if not existing
 
-        This is slightly non-trivial because we store children in a sparse
-        list. Maybe we should use a defaultdict.
+        Children are stored in a sparse list sorted by address, indexed by
+        child_index_. @address is either the full address tuple or just its
+        last component.
         """
-        if isinstance(address, int): address = self.address + (address,)
+        if isinstance(address, int):
+            return self.child_at(address)
         assert address[:-1] == self.address
-        i = -1
-        for i, child in enumerate(self.children):
-            if child.address == address:
-                return child
-            if child.address > address:
-                i = i - 1
-                break
-        i += 1
-        self.children.insert(i, Memref(self, address, self.trace.opaque()))
-        return self.children[i]
+        return self.child_at(address[-1])
+
+    def child_at(self, key):
+        """Like child, but takes only the last address component @key"""
+        child = self.child_index_.get(key)
+        if child is None:
+            address = self.address + (key,)
+            child = Memref(self, address, self.trace.opaque())
+            i = bisect.bisect(self.children, key, key=memref_key)
+            self.children.insert(i, child)
+            self.child_index_[key] = child
+        return child
 
     def lookup(self, address):
-        """Recursive child lookup"""
+        """Child lookup, descending one address component at a time"""
         assert address[:len(self.address)] == self.address
-        if address == self.address:
-            return self
-        child = self.child(address[:len(self.address) + 1])
-        return child.lookup(address)
+        node = self
+        for key in address[len(self.address):]:
+            node = node.child_at(key)
+        return node
 
     def pprint(self, depth=0):
         """Pretty-print the memory location"""
@@ -245,13 +345,47 @@ class Memref:
 
     def __add__(self, rhs):
         """Pointer addition"""
-        next_address = self.address[:-1] + (self.address[-1] + rhs,)
-        return self.parent.child(next_address)
+        return self.parent.child_at(self.key_ + rhs)
 
     def __str__(self):
         """Compact string representation"""
         return "<Memref: " + str(self.address) + ">"
 
+class ExplainContext_:
+    """Context manager returned by Trace.explain
+
+    Each Trace has just one; Trace.explain leaves the explanation to push in
+    trace.pending_explanation_ right before it is entered.
+    """
+    __slots__ = ("trace",)
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        if not self.trace.pause_explanation_:
+            self.trace.explanation_stack.append(
+                self.trace.pending_explanation_)
+
+    def __exit__(self, *_):
+        if not self.trace.pause_explanation_:
+            self.trace.explanation_stack.pop()
+
+class PauseExplainContext_:
+    """Context manager returned by Trace.freeze_explanation (one per Trace)"""
+    __slots__ = ("trace",)
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.trace.pause_explanation_ += 1
+
+    def __exit__(self, *_):
+        self.trace.pause_explanation_ -= 1
+        if not self.trace.pause_explanation_:
+            self.trace.small_ints_.clear()
+
 class Trace:
     """Manages state for an interpretation run"""
     def __init__(self):
@@ -259,13 +393,34 @@ class Trace:
         self.counter = 0
         self.explanation_stack = [None]
         self.pause_explanation_ = 0
+        self.pending_explanation_ = None
+        self.explain_context_ = ExplainContext_(self)
+        self.pause_context_ = PauseExplainContext_(self)
+        # Maps small int -> a shared Value for it, only used while
+        # explanations are frozen; see concrete
+        self.small_ints_ = dict()
 
         # Maps string -> dstloc
         self.scopes = [dict()]
+        # Maps string -> dstloc as resolved against the current scope stack,
+        # kept up to date by push_scope/pop_scope. bound_names_ has, for each
+        # scope, the names that resolve to it.
+        self.resolved_ = dict()
+        self.bound_names_ = [[]]
 
+        # Maps field name -> its numerical offset, see field_offset
         self.offsets = dict()
         self.memory = Memref(None, tuple(), None, trace=self)
-        self.val_explanation_stack = []
+        # Explanation frame of the innermost emit, [explanation, *values]; the
+        # enclosing frames are held by the emit calls themselves.
+        self.val_frame_ = None
+
+    def field_offset(self, name):
+        """Offset of the field labeled @name, assigning the next one if new"""
+        offset = self.offsets.get(name)
+        if offset is None:
+            offset = self.offsets[name] = len(self.offsets)
+        return offset
 
     def emit(self, expr):
         """Perform an operation on the state
@@ -274,11 +429,18 @@ class Trace:
         explanations for the values so that users can trace back where a value
         came from.
         """
-        self.val_explanation_stack.append([self.explanation])
+        frame = self.val_frame_
+        if isinstance(expr, Value):
+            # Already-computed operands need no explanation frame of their
+            # own; they only get recorded in their parent's.
+            if frame is not None:
+                frame.append(expr)
+            return expr
+        self.val_frame_ = [self.explanation]
         result = self.emit_(expr)
-        self.val_explanation_stack.pop()
-        if self.val_explanation_stack and isinstance(result, Value):
-            self.val_explanation_stack[-1].append(result)
+        self.val_frame_ = frame
+        if frame is not None and isinstance(result, Value):
+            frame.append(result)
         return result
 
     def emit_(self, expr):
@@ -290,15 +452,22 @@ class Trace:
         """
         if isinstance(expr, Value): return expr
         op = expr[0]
-        if op in ("+", "==", "!=", "<") or op.startswith("bin_"):
-            if op.startswith("bin_"): op = op[len("bin_"):]
-            if op == "/": op = "//"
+        fn = binop(op)
+        if fn is not None:
             _, src1, src2 = expr
-            return self.operate(lambda x, y: eval(f"x {op} y"),
-                                [self.emit(src1), self.emit(src2)])
+            val1, val2 = self.emit(src1), self.emit(src2)
+            # Fast path for concrete operands; operate handles the rest
+            root1, root2 = val1.find(), val2.find()
+            if root1.concrete and root2.concrete:
+                return self.concrete(fn(root1.value, root2.value))
+            return self.operate(fn, [val1, val2])
         elif op in ("-", "~"):
             _, src1 = expr
-            return self.operate(lambda x: eval(f"{op}{x}"), [self.emit(src1)])
+            val = self.emit(src1)
+            root = val.find()
+            if root.concrete:
+                return self.concrete(UNOPS[op](root.value))
+            return self.operate(UNOPS[op], [val])
         elif op == "assert":
             _, claim = expr
             # TODO: do something with this. Assertions are not assertions at
@@ -307,13 +476,13 @@ class Trace:
             # emit, essentially, (assert (== x (imm 0))).
         elif op == "imm":   # Immediate
             _, imm = expr
-            return Value(imm, True, self)
+            return self.concrete(imm)
         elif op == "*":     # Dereference
             _, src = expr
             return self.emit(src).as_memref().get_value()
         elif op == "str":   # Store into a new memory slot
             _, src = expr
-            new_memref = self.memory.append().child(0)
+            new_memref = self.memory.append().child_at(0)
             new_memref.set_value(self.emit(src))
             return Value(new_memref, True, self)
         elif op == "upd":   # Update a location in memory
@@ -327,11 +496,8 @@ class Trace:
             _, headptr, src = expr
             field_name = self.emit(src).value
             assert isinstance(field_name, str) # NOT passed by reference
-            if field_name not in self.offsets:
-                self.offsets[field_name] = Value(len(self.offsets), True, self)
             head = self.emit(headptr).as_memref().child(0)
-            return Value(head + self.offsets[field_name].canonical.value,
-                         True, self)
+            return Value(head + self.field_offset(field_name), True, self)
         else:
             print(expr)
             raise NotImplementedError
@@ -339,9 +505,9 @@ class Trace:
     @property
     def val_explanation(self):
         """Gets a source-level explanation for the current operation"""
-        if not self.val_explanation_stack:
+        if self.val_frame_ is None:
             return [self.explanation]
-        return self.val_explanation_stack[-1]
+        return self.val_frame_
 
     # TODO value explanations
     def operate(self, operator, vals):
@@ -351,17 +517,38 @@ class Trace:
         and return a corresponding new Value. Otherwise, it will make a
         symbolic Value with that expression tree.
         """
-        if not all(val.canonical.concrete for val in vals):
+        if not all(val.find().concrete for val in vals):
             return Value([operator] + vals, False, self)
-        return Value(operator(*[v.canonical.value for v in vals]), True, self)
+        return self.concrete(operator(*[v.cval() for v in vals]))
+
+    def concrete(self, value):
+        """New Value for the concrete @value
+
+        While explanations are frozen, small ints (in CPython's small-int
+        range) share a single Value each instead of allocating a new one.
+        """
+        if (not self.pause_explanation_ or type(value) is not int
+                or not -5 <= value <= 256):
+            return Value(value, True, self)
+        if value not in self.small_ints_:
+            self.small_ints_[value] = Value(value, True, self)
+        return self.small_ints_[value]
 
     def push_scope(self, param_names, args):
         """Push a new scope on to the scope stack (e.g., calling function)"""
-        self.scopes.append(dict(zip(param_names, args)))
+        scope = dict(zip(param_names, args))
+        self.scopes.append(scope)
+        # Names already bound in an outer scope keep resolving there
+        bound = [name for name in scope if name not in self.resolved_]
+        for name in bound:
+            self.resolved_[name] = scope[name]
+        self.bound_names_.append(bound)
 
     def pop_scope(self):
         """Pop a scope from the stack"""
         self.scopes.pop()
+        for name in self.bound_names_.pop():
+            del self.resolved_[name]
 
     def local(self, name):
         """Return a local variable from the latest scope
@@ -369,11 +556,10 @@ class Trace:
         If no such variable with this name exists, will create it in the
         bottom-most scope.
         """
-        for scope in self.scopes:
-            if name in scope:
-                return scope[name]
-        self.scopes[-1][name] = self.opaque()
-        return self.scopes[-1][name]
+        if name not in self.resolved_:
+            self.scopes[-1][name] = self.resolved_[name] = self.opaque()
+            self.bound_names_[-1].append(name)
+        return self.resolved_[name]
 
     def explain(self, explanation):
         """Syntax sugar for pushing/popping from the explanation stack
@@ -382,24 +568,15 @@ class Trace:
         input, it calls trace.explain(lexemes) to indicate that any operations
         performed are a result of execution of those lexemes.
         """
-        class __ExplainContext:
-            def __enter__(_):
-                if not self.pause_explanation_:
-                    self.explanation_stack.append(explanation)
-            def __exit__(_, __, ___, ____):
-                if not self.pause_explanation_:
-                    self.explanation_stack.pop()
-        return __ExplainContext()
+        self.pending_explanation_ = explanation
+        return self.explain_context_
 
     def freeze_explanation(self):
         """While this context is entered, no new explanations are pushed/popped
 
         Useful when executing code directly generated by a stub.
         """
-        class __PauseExplainContext:
-            def __enter__(_): self.pause_explanation_ += 1
-            def __exit__(_, __, ___, ____): self.pause_explanation_ -= 1
-        return __PauseExplainContext()
+        return self.pause_context_
 
     @property
     def explanation(self):
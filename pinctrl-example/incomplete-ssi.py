@@ -1,4 +1,5 @@
 from framework.interpreter import *
+from framework.repl import REPL
 
 interpreter = Interpreter("example_pinctrl/pinctrl-bcm2835.c")
 true = interpreter.trace.local("true")
@@ -7,13 +8,13 @@ true.as_memref().set_value(Value(1, True, interpreter.trace))
 # Execute any MODULE_* lines, saving data about the module.
 module_data = dict({"authors": [], "description": None, "license": None, "driver_struct": None})
 def register_author(name_reg):
-    module_data["authors"].append(name_reg.value.value.value)
+    module_data["authors"].append(name_reg.get_value())
 interpreter.register_fn("MODULE_AUTHOR", register_author)
 def register_description(descr_reg):
-    module_data["description"] = descr_reg.value.value.value
+    module_data["description"] = descr_reg.get_value()
 interpreter.register_fn("MODULE_DESCRIPTION", register_description)
 def register_license(license_reg):
-    module_data["license"] = license_reg.value.value.cval()
+    module_data["license"] = license_reg.get_value()
 interpreter.register_fn("MODULE_LICENSE", register_license)
 def register_driver_struct(struct_reg):
     module_data["driver_struct"] = struct_reg.cval()
@@ -35,12 +36,10 @@ of_match_table = interpreter.exec_c("{0}.driver.of_match_table[0]",
 
 print("Choose device:")
 datas = []
-for i in range(len(of_match_table.children) - 1):
-    compatible = interpreter.exec_c(f"{{0}}.driver.of_match_table[{i}].compatible",
-                                    module_data["driver_struct"]).cval().get_value().cval()
+for i, entry in enumerate(of_match_table.children[:-1]):
+    compatible = entry.field("compatible").get_value().cval()
     print(i, ":", compatible)
-    data = interpreter.exec_c(f"{{0}}.driver.of_match_table[{i}].data",
-                              module_data["driver_struct"]).cval().get_value().cval()
+    data = entry.field("data").get_value().cval()
     datas.append((compatible, data))
 data = datas[int(input("Choice: "))]
 
@@ -50,7 +49,7 @@ interpreter.register_fn("devm_kzalloc", kzalloc)
 interpreter.register_fn("devm_kcalloc", kzalloc)
 
 def of_device_is_compatible(np, string):
-    string = string.cval().get_value().cval()
+    string = string.get_value()
     return interpreter.emit("(str (imm {0}))", string == data[0])
 interpreter.register_fn("of_device_is_compatible", of_device_is_compatible)
 
@@ -88,53 +87,30 @@ interpreter.register_fn("BIT", BIT)
 
 interpreter.register_fn("explain", lambda x: interpreter.emit("(* {0})", x).explain())
 
-def REPL(interpreter):
+def cmd_probe(interpreter, args):
     global pc
-    if interpreter.curr_lexeme:
-        print("ssi :: On line", interpreter.curr_lexeme.line_number)
-    while True:
-        command = input("ssi > ")
-        if command == "pm":
-            interpreter.trace.memory.print_pyify()
-        elif command.startswith("b "):
-            line_number = int(command.split(" ")[1])
-            interpreter.break_lines[line_number] = REPL
-        elif command.startswith("xc "):
-            command = command[len("xc "):]
-            result = interpreter.exec_c(command)
-            result.as_memref().print_pyify()
-        elif command == "probe":
-            pc = interpreter.trace.opaque()
-            interpreter.trace.push_scope(["pc"], [pc])
-            interpreter.returnify_fn(probe[1][0])
-            interpreter.curr_lexeme = probe[1][0]
-            for _ in range(200):
-                try: result = interpreter.step()
-                except StopIteration: break
-                if result and result[0] == "return": break
-            interpreter.trace.pop_scope()
-        elif command.startswith("enable-irq "):
-            which_one = int(command.split(" ")[1])
-            def irqd_to_hwirq(*args):
-                return interpreter.exec_c(f"{which_one}")
-            interpreter.register_fn("irqd_to_hwirq", irqd_to_hwirq)
-            fn = interpreter.exec_c("{0}->gpio_chip.irq.chip->irq_enable", pc.cval())
-            _, (start_lex, param_names) = fn.cval().get_value().cval()
-            interpreter.returnify_fn(start_lex)
-            assert param_names == ["data"]
-            interpreter.trace.push_scope(param_names, [interpreter.trace.opaque()])
-            interpreter.curr_lexeme = start_lex
-            for _ in range(200):
-                try: result = interpreter.step()
-                except StopIteration: break
-                if result and result[0] == "return": break
-            interpreter.trace.pop_scope()
-        elif command.startswith("verbose "):
-            fn_name = command.split(" ")[1]
-            formatters = command.split(" ")[2:]
-            interpreter.verbose_fns[fn_name] = formatters
-        elif command == "c":
-            break
-        else:
-            print(f"ssi > Unknown command '{command}'")
-REPL(interpreter)
+    pc = interpreter.trace.opaque()
+    interpreter.trace.push_scope(["pc"], [pc])
+    interpreter.returnify_fn(probe[1][0])
+    interpreter.curr_lexeme = probe[1][0]
+    interpreter.run_until_return(max_steps=200)
+    interpreter.trace.pop_scope()
+
+def cmd_enable_irq(interpreter, args):
+    which_one = int(args.split(" ")[0])
+    # The hardware IRQ number is fixed for this command, so build it once
+    hwirq = interpreter.exec_c(f"{which_one}")
+    def irqd_to_hwirq(*args):
+        return hwirq
+    interpreter.register_fn("irqd_to_hwirq", irqd_to_hwirq)
+    fn = interpreter.exec_c("{0}->gpio_chip.irq.chip->irq_enable", pc.cval())
+    _, (start_lex, param_names) = fn.get_value()
+    interpreter.returnify_fn(start_lex)
+    assert param_names == ["data"]
+    interpreter.trace.push_scope(param_names, [interpreter.trace.opaque()])
+    interpreter.curr_lexeme = start_lex
+    interpreter.run_until_return(max_steps=200)
+    interpreter.trace.pop_scope()
+
+REPL(interpreter, dict({"probe": cmd_probe}),
+     dict({"enable-irq": cmd_enable_irq}))
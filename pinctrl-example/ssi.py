@@ -1,6 +1,7 @@
 """Basic SSI for the pinctrl driver
 """
 from framework.interpreter import *
+from framework.repl import REPL
 
 # Initialize the interpreter
 interpreter = Interpreter("pinctrl-bcm2835.c")
@@ -46,36 +47,70 @@ of_match_table = interpreter.exec_c("{0}.driver.of_match_table[0]",
 # "data" (the corresponding device metadata to use).
 print("Choose device:")
 datas = []
-for i in range(len(of_match_table.children) - 1):
-    compatible = interpreter.exec_c(f"{{0}}.driver.of_match_table[{i}].compatible",
-                                    module_data["driver_struct"]).get_value()
+for i, entry in enumerate(of_match_table.children[:-1]):
+    compatible = entry.field("compatible").get_value().cval()
     print(i, ":", compatible)
-    data = interpreter.exec_c(f"{{0}}.driver.of_match_table[{i}].data",
-                              module_data["driver_struct"]).get_value()
+    data = entry.field("data").get_value().cval()
     datas.append((compatible, data))
 data = datas[int(input("Choice: "))]
 # data is now a tuple of (device_id_string, bcm_plat_data) to use for this chip
 
 ######### Now we model the module-system interface. ########
 
+# Stubs return their results as (str (imm ...)), a fresh temporary holding the
+# value. Nothing ever writes through a stub's return value, so each distinct
+# constant can share a single temporary (built on first use).
+constant_results = dict()
+def constant_result(value):
+    key = (type(value), value)
+    if key not in constant_results:
+        constant_results[key] = interpreter.emit("(str (imm {0}))", value)
+    return constant_results[key]
+
 # Assume we're "compatible" with a device string iff this is the device string
 # we chose.
 def of_device_is_compatible(np, string):
     string = string.get_value()
-    return interpreter.emit("(str (imm {0}))", string == data[0])
+    return constant_result(string == data[0])
 interpreter.register_fn("of_device_is_compatible", of_device_is_compatible)
 
-# Helper method to find a device MMIO address in a DTSI file.
+# Helper method to find a device MMIO address in a DTSI file. Every probe asks
+# again, so the file is only read and scanned once, recording where each
+# single-string compatible = "..."; is, and each address only looked up once.
+dtsi_files = dict()
+dtsi_addresses = dict()
+def dtsi_index(dtsi):
+    prefix = 'compatible = "'
+    compatibles = dict()
+    idx = dtsi.find(prefix)
+    while idx != -1:
+        start = idx + len(prefix)
+        end = dtsi.find('"', start)
+        if end == -1:
+            break
+        if dtsi.startswith('";', end):
+            compatibles.setdefault(dtsi[start:end], idx)
+        idx = dtsi.find(prefix, start)
+    return compatibles
+
 def dtsi_find(dtsi_file, device_string):
     from framework.lex import path_to_string
-    dtsi = path_to_string(dtsi_file)
-    try:
-        idx = dtsi.index(f'compatible = "{device_string}";')
-    except ValueError:
+    key = (dtsi_file, device_string)
+    if key not in dtsi_addresses:
+        if dtsi_file not in dtsi_files:
+            dtsi = path_to_string(dtsi_file)
+            dtsi_files[dtsi_file] = (dtsi, dtsi_index(dtsi))
+        dtsi, compatibles = dtsi_files[dtsi_file]
+        if device_string in compatibles:
+            idx = compatibles[device_string]
+            dtsi_addresses[key] = dtsi[idx:].split(";")[1].split("<")[1].split(" ")[0]
+        else:
+            dtsi_addresses[key] = None
+    if dtsi_addresses[key] is None:
         print(f"SSI: Could not find {device_string} in the DTSI file {dtsi_file}!")
         print("SSI: Defaulting to address zero...")
         return "0"
-    return dtsi[idx:].split(";")[1].split("<")[1].split(" ")[0]
+    return dtsi_addresses[key]
 
 # Requesting a resource should look up the corresponding MMIO address in the
 # DTSI file, then assign the out parameter ptr_to_iomem to that address. NOTE:
@@ -85,7 +120,7 @@ def of_address_to_resource(np, which_resource, ptr_to_iomem):
     assert which_resource.get_value() == 0
     addr = dtsi_find("bcm283x.dtsi", data[0])
     interpreter.exec_c(f"*{{0}} = {addr}", ptr_to_iomem.cval())
-    return interpreter.emit("(str (imm {0}))", 0)
+    return constant_result(0)
 interpreter.register_fn("of_address_to_resource", of_address_to_resource)
 
 # I think ioremap_resource is supposed to map the physical address into a
@@ -96,9 +131,20 @@ def devm_ioremap_resource(dev, ptr_to_iomem):
 interpreter.register_fn("devm_ioremap_resource", devm_ioremap_resource)
 
 # I think this is a macro defined somewhere else, this seems to be a reasonable
-# interpretation of what it does...
+# interpretation of what it does... Only a handful of distinct bits ever get
+# asked for, so concrete integer ones are computed once and their result
+# shared, like constant_result. Anything else (e.g., an opaque bit) is computed
+# afresh every time.
+bit_results = dict()
 def BIT(val):
-    return interpreter.exec_c("(1 << ({0}))", val)
+    if not (val.find().concrete and isinstance(val.cval(), Memref)):
+        return interpreter.exec_c("(1 << ({0}))", val)
+    bit = val.get_value()
+    if not isinstance(bit, int):
+        return interpreter.exec_c("(1 << ({0}))", val)
+    if bit not in bit_results:
+        bit_results[bit] = interpreter.exec_c("(1 << ({0}))", val)
+    return bit_results[bit]
 interpreter.register_fn("BIT", BIT)
 
 # Stateful driver information is shared using a struct bcm2835_pinctrl
@@ -118,7 +164,7 @@ interpreter.register_fn("gpiochip_get_data", gpiochip_get_data)
 # error-handling paths, so we stub a bunch of methods as doing nothing other
 # than return 0. Long-term, path exploration should remove the need to do this.
 def always_zero(*args):
-    return interpreter.emit("(str (imm {0}))", 0)
+    return constant_result(0)
 interpreter.register_fn("IS_ERR", always_zero)
 interpreter.register_fn("gpiochip_add_data", always_zero)
 interpreter.register_fn("readl", always_zero)
@@ -135,56 +181,33 @@ interpreter.register_fn("devm_kcalloc", kzalloc)
 # as long as it finds "something," so we can approximate it with a malloc.
 interpreter.register_fn("of_match_node", kzalloc)
 
-# Now we do the actual REPL. All the commands other than "probe" and
-# "enable-irq" are basically boilerplate that can be copied over to other SSIs.
-def REPL(interpreter):
+# Now we do the actual REPL. The generic commands come from framework/repl.py;
+# on top of those we add "probe" and "enable-irq".
+def cmd_probe(interpreter, args):
     global pc
-    if interpreter.curr_lexeme:
-        print("ssi :: On line", interpreter.curr_lexeme.line_number)
-    while True:
-        command = input("ssi > ")
-        if command == "pm":
-            interpreter.trace.memory.print_pyify()
-        elif command.startswith("b "):
-            line_number = int(command.split(" ")[1])
-            interpreter.break_lines[line_number] = REPL
-        elif command.startswith("xc "):
-            command = command[len("xc "):]
-            result = interpreter.exec_c(command)
-            result.as_memref().print_pyify()
-        elif command.startswith("verbose "):
-            fn_name = command.split(" ")[1]
-            formatters = command.split(" ")[2:]
-            interpreter.verbose_fns[fn_name] = formatters
-        elif command == "c":
-            break
-        elif command == "probe":
-            probe = module_data["driver_struct"].field("probe").get_value().cval()
-            pc = interpreter.trace.opaque()
-            interpreter.trace.push_scope(["pc"], [pc])
-            interpreter.returnify_fn(probe[1][0])
-            interpreter.curr_lexeme = probe[1][0]
-            while True:
-                try: result = interpreter.step()
-                except StopIteration: break
-                if result and result[0] == "return": break
-            interpreter.trace.pop_scope()
-        elif command.startswith("enable-irq "):
-            which_one = int(command.split(" ")[1])
-            def irqd_to_hwirq(*args):
-                return interpreter.exec_c(f"{which_one}")
-            interpreter.register_fn("irqd_to_hwirq", irqd_to_hwirq)
-            fn = interpreter.exec_c("{0}->gpio_chip.irq.chip->irq_enable", pc.cval())
-            _, (start_lex, param_names) = fn.get_value()
-            interpreter.returnify_fn(start_lex)
-            assert param_names == ["data"]
-            interpreter.trace.push_scope(param_names, [interpreter.trace.opaque()])
-            interpreter.curr_lexeme = start_lex
-            while True:
-                try: result = interpreter.step()
-                except StopIteration: break
-                if result and result[0] == "return": break
-            interpreter.trace.pop_scope()
-        else:
-            print(f"ssi > Unknown command '{command}'")
-REPL(interpreter)
+    probe = module_data["driver_struct"].field("probe").get_value().cval()
+    pc = interpreter.trace.opaque()
+    interpreter.trace.push_scope(["pc"], [pc])
+    interpreter.returnify_fn(probe[1][0])
+    interpreter.curr_lexeme = probe[1][0]
+    interpreter.run_until_return()
+    interpreter.trace.pop_scope()
+
+def cmd_enable_irq(interpreter, args):
+    which_one = int(args.split(" ")[0])
+    # The hardware IRQ number is fixed for this command, so build it once
+    hwirq = interpreter.exec_c(f"{which_one}")
+    def irqd_to_hwirq(*args):
+        return hwirq
+    interpreter.register_fn("irqd_to_hwirq", irqd_to_hwirq)
+    fn = interpreter.exec_c("{0}->gpio_chip.irq.chip->irq_enable", pc.cval())
+    _, (start_lex, param_names) = fn.get_value()
+    interpreter.returnify_fn(start_lex)
+    assert param_names == ["data"]
+    interpreter.trace.push_scope(param_names, [interpreter.trace.opaque()])
+    interpreter.curr_lexeme = start_lex
+    interpreter.run_until_return()
+    interpreter.trace.pop_scope()
+
+REPL(interpreter, dict({"probe": cmd_probe}),
+     dict({"enable-irq": cmd_enable_irq}))